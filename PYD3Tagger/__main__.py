@@ -0,0 +1,10 @@
+"""Runs the headless command line interface, without loading wx or PIL.
+
+Invoke with
+  > python -m PYD3Tagger [-n] [-w WORKERS] [-v] RULES DIRECTORY
+"""
+import sys
+from PYD3Tagger.cli import main
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+import collections
+import hashlib
+import struct
+
+
+def image_size(data):
+    """Returns (width, height) from the header of a PNG, GIF or JPEG image, (0, 0) if unknown."""
+    if data[0:8] == b"\x89PNG\r\n\x1a\n" and data[12:16] == b"IHDR":
+        return struct.unpack(">II", data[16:24])
+    if data[0:6] in (b"GIF87a", b"GIF89a"):
+        return struct.unpack("<HH", data[6:10])
+    if data[0:2] == b"\xff\xd8":
+        # The size is found in the first start of frame segment.
+        position = 2
+        while position + 9 <= len(data) and data[position:position+1] == b"\xff":
+            marker = bytearray(data[position+1:position+2])[0]
+            length = struct.unpack(">H", data[position+2:position+4])[0]
+            if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                height, width = struct.unpack(">HH", data[position+5:position+9])
+                return width, height
+            position += 2 + length
+    return 0, 0
+
+
+class Picture(object):
+    """Describes an embedded picture, its data is only loaded and written to disk on demand.
+
+    type is the ID3/FLAC picture type, 3 for front covers. Pictures read
+    from files carry a loader for every file holding them, their data can
+    be dropped and is read again once it is rendered or copied. Loaders
+    whose file no longer holds the picture are skipped and dropped.
+    """
+
+    def __init__(self, data=None, mime="", hash=None, type=3, desc="", width=0, height=0,
+                 size=None, loader=None):
+        self.raw = data
+        self.mime = mime
+        if hash is None:
+            hash = hashlib.sha1(data).hexdigest()
+        self.hash = hash
+        self.type = type
+        self.desc = desc
+        if data is not None and not (width and height):
+            width, height = image_size(data)
+        self.width = width
+        self.height = height
+        self.size = len(data) if size is None else size
+        self.loaders = []
+        self.add_loader(loader)
+        # Copies of the data in the form some formats store it, shared by all files holding it.
+        self.encoded = {}
+        self.tmp = None
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def data(self):
+        """The image data, read through the loader if it is not in memory."""
+        if self.raw is None:
+            self.raw = self.reload()
+        return self.raw
+
+    def add_loader(self, loader):
+        """Adds a callable returning the data, such as another file holding the same picture."""
+        if loader is not None and loader not in self.loaders:
+            self.loaders.append(loader)
+
+    def reload(self):
+        """Reads the data through the first loader that still returns this picture."""
+        while self.loaders:
+            try:
+                data = self.loaders[0]()
+            except (IOError, OSError):
+                data = None
+            if data is not None and hashlib.sha1(data).hexdigest() == self.hash:
+                return data
+            # The file is gone or its picture was replaced since.
+            self.loaders.pop(0)
+        raise IOError("Picture %s is no longer held by any file" % self.hash)
+
+    def is_loaded(self):
+        return self.raw is not None
+
+    def unload(self):
+        """Drops the data if it can be read again."""
+        if self.loaders:
+            self.raw = None
+            self.encoded = {}
+
+    def describe(self):
+        """Returns the picture's metadata as a dictionary, without loading its data."""
+        return {"type": self.type, "desc": self.desc, "mime": self.mime, "width": self.width,
+                "height": self.height, "size": self.size, "hash": self.hash}
+
+    def get_buffer(self):
+        """Returns the picture data without copying it."""
+        return memoryview(self.data)
+
+    @property
+    def name(self):
+        """Path of a tempfile holding the picture, materialized on first access."""
+        if self.tmp is None:
+            suffix = "." + self.mime.split("/")[-1] if "/" in self.mime else ""
+            import tempfile
+            # The tempfile lives as long as the picture and is removed with it.
+            self.tmp = tempfile.NamedTemporaryFile(suffix=suffix)
+            self.tmp.write(self.data)
+            self.tmp.flush()
+        return self.tmp.name
+
+
+class ArtworkCache(object):
+    """Deduplicates pictures by content hash, type and description, keeps the most recent ones in memory.
+
+    Once the pictures exceed max_bytes the least recently used ones are
+    dropped and unload their data, the most recent picture is always kept.
+    """
+
+    def __init__(self, max_bytes=64*1024*1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.pictures = collections.OrderedDict()
+
+    def get(self, data, mime="", loader=None, **info):
+        """Returns the shared Picture for the given image data.
+
+        With a loader the data may be dropped later and read through it
+        again, the loaders of all files sharing a picture are kept. info
+        are further Picture attributes like type and desc.
+        """
+        hash = hashlib.sha1(data).hexdigest()
+        key = (hash, info.get("type", 3), info.get("desc", ""))
+        picture = self.pictures.pop(key, None)
+        if picture is None:
+            picture = Picture(data, mime, hash, loader=loader, **info)
+            self.size += len(picture)
+        else:
+            picture.add_loader(loader)
+            if not picture.is_loaded():
+                picture.raw = data
+        self.pictures[key] = picture
+        while self.size > self.max_bytes and len(self.pictures) > 1:
+            evicted_key, evicted = self.pictures.popitem(last=False)
+            evicted.unload()
+            self.size -= len(evicted)
+        return picture
+
+    def clear(self):
+        self.pictures.clear()
+        self.size = 0
@@ -0,0 +1,316 @@
+"""Reproducible performance benchmarks for the Tagger on a synthetic corpus.
+
+The corpus is generated locally with mutagen, so runs on different
+machines and revisions are comparable. Invoke with
+  > python bench.py [--files N] [--formats mp3,flac,ogg] [--json]
+"""
+import argparse
+import base64
+from io import BytesIO
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import mutagen
+from mutagen import flac, id3, oggvorbis
+from mutagen.ogg import OggPage
+from PYD3Tagger import image
+from PYD3Tagger.tagger import Tagger
+
+# Seconds a headless import of the Tagger may take, see measure_startup.
+startup_target = 0.3
+
+# Times a fresh import of the Tagger and reports whether the GUI or imaging libraries came along.
+startup_script = """
+import sys, time
+started = time.time()
+import PYD3Tagger.tagger
+seconds = time.time() - started
+print("%f %d" % (seconds, any(name in sys.modules for name in ["wx", "PIL", "PYD3Tagger.image"])))
+"""
+
+images_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
+
+# A silent MPEG-1 Layer III frame, 128 kbit/s at 44.1 kHz, 1152 samples long.
+mp3_frame = b"\xff\xfb\x90\x00" + b"\x00" * 413
+mp3_frames_per_second = 44100 // 1152
+
+
+def make_cover(size, seed=0):
+    """Returns a noisy JPEG of size x size pixels, noise defeats compression like a photo."""
+    from PIL import Image
+    noise = random.Random(seed)
+    pixels = bytes(bytearray(noise.getrandbits(8) for i in range(size * size * 3)))
+    buf = BytesIO()
+    Image.frombytes("RGB", (size, size), pixels).save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+
+def make_tags(number, total, tag_size):
+    """Returns the easy tags of a synthetic track with a comment of tag_size bytes."""
+    return {"artist": "Synthetic Artist", "album": "Synthetic Album %d" % (number // 10),
+            "title": "Track %d" % number, "genre": "Noise",
+            "tracknumber": "%d/%d" % (number % 10 + 1, total),
+            "comment": "x" * tag_size}
+
+
+def write_mp3(path, seconds, tags, cover):
+    with open(path, "wb") as handle:
+        handle.write(mp3_frame * (seconds * mp3_frames_per_second))
+    file = mutagen.File(path, easy=True)
+    file.add_tags()
+    for key in ["artist", "album", "title", "genre", "tracknumber"]:
+        file[key] = tags[key]
+    file.save()
+    file = mutagen.File(path)
+    file.tags.add(id3.COMM(3, "eng", "", tags["comment"]))
+    if cover:
+        file.tags.add(id3.APIC(3, "image/jpeg", 3, "Cover (front)", cover))
+    file.save()
+
+
+def flac_picture(cover):
+    picture = flac.Picture()
+    picture.type = 3
+    picture.mime = "image/jpeg"
+    picture.desc = "Cover (front)"
+    picture.data = cover
+    return picture
+
+
+def write_flac(path, seconds, tags, cover):
+    samples = seconds * 44100
+    # STREAMINFO: block and frame sizes, 44.1 kHz, 2 channels, 16 bit, sample count, MD5.
+    info = struct.pack(">HHHBHB", 4096, 4096, 0, 0, 0, 0)
+    info += struct.pack(">Q", (44100 << 44) | (1 << 41) | (15 << 36) | samples) + b"\x00" * 16
+    with open(path, "wb") as handle:
+        handle.write(b"fLaC" + struct.pack(">BBH", 0x80, 0, len(info)) + info)
+        handle.write(b"\x00" * (seconds * 16000))
+    file = flac.FLAC(path)
+    file.update(tags)
+    if cover:
+        file.add_picture(flac_picture(cover))
+    file.save()
+
+
+def write_ogg(path, seconds, tags, cover):
+    ident = b"\x01vorbis" + struct.pack("<IBIiiiBB", 0, 2, 44100, 0, 128000, 0, 0xb8, 1)
+    comment = b"\x03vorbis" + struct.pack("<I", 9) + b"synthetic" + struct.pack("<I", 0) + b"\x01"
+    setup = b"\x05vorbis" + b"\x00" * 32
+    packets = [[ident], [comment, setup]] + [[b"\x00" * 4000] for i in range(seconds * 4)]
+    with open(path, "wb") as handle:
+        for (sequence, page_packets) in enumerate(packets):
+            page = OggPage()
+            page.packets = page_packets
+            page.serial = 1
+            page.sequence = sequence
+            page.first = sequence == 0
+            page.last = sequence == len(packets) - 1
+            page.position = max(sequence - 1, 0) * 11025
+            handle.write(page.write())
+    file = oggvorbis.OggVorbis(path)
+    file.update(tags)
+    if cover:
+        data = base64.b64encode(flac_picture(cover).write())
+        file["metadata_block_picture"] = [data.decode("ascii")]
+    file.save()
+
+
+writers = {"mp3": write_mp3, "flac": write_flac, "ogg": write_ogg}
+
+
+def make_corpus(root, files=100, formats=("mp3", "flac", "ogg"), seconds=5, tag_size=256,
+                cover_size=500, albums=10):
+    """Generates a tree of synthetic tagged files below root, returns their paths.
+
+    Files are spread over albums directories, each album shares one cover
+    of cover_size x cover_size pixels (0 for no covers).
+    """
+    paths = []
+    covers = {}
+    for number in range(files):
+        album = number % albums
+        if cover_size and album not in covers:
+            covers[album] = make_cover(cover_size, album)
+        directory = os.path.join(root, "Album %02d" % album)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        format = formats[number % len(formats)]
+        path = os.path.join(directory, "%05d.%s" % (number, format))
+        writers[format](path, seconds, make_tags(number, files, tag_size), covers.get(album))
+        paths.append(path)
+    return paths
+
+
+def memory_status(field):
+    """Returns a memory field of the process status in kB, if known."""
+    try:
+        with open("/proc/self/status") as handle:
+            for line in handle:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def start_memory():
+    """Resets the peak resident memory of the process, returns the memory resident now or None."""
+    try:
+        # Linux starts tracking the peak anew, without slowing the process down.
+        with open("/proc/self/clear_refs", "w") as handle:
+            handle.write("5")
+    except IOError:
+        return None
+    return memory_status("VmRSS")
+
+
+def peak_memory(resident):
+    """Returns the peak resident memory in kB on top of what start_memory found, if known."""
+    if resident is None:
+        return None
+    peak = memory_status("VmHWM")
+    if peak is None:
+        return None
+    return max(peak - resident, 0)
+
+
+def written_bytes():
+    """Returns the number of bytes written by the process so far, if known."""
+    try:
+        with open("/proc/self/io") as handle:
+            for line in handle:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def measure(name, count, function, *args):
+    """Runs a benchmark once and returns its result record.
+
+    peak_memory_kb is the peak resident memory the benchmark needed on
+    top of what was resident before it, so every stage is reported on
+    its own.
+    """
+    # The peak is reset first, the reset itself is a write of the process.
+    resident = start_memory()
+    written = written_bytes()
+    started = time.time()
+    function(*args)
+    seconds = time.time() - started
+    peak = peak_memory(resident)
+    if written is not None:
+        written = written_bytes() - written
+    return {"name": name, "count": count, "seconds": round(seconds, 4),
+            "per_second": round(count / seconds, 1) if seconds else None,
+            "peak_memory_kb": peak, "bytes_written": written}
+
+
+def measure_startup(runs=5):
+    """Returns the result record of importing the Tagger in fresh interpreters, the median of runs.
+
+    The record also carries the startup_target and whether wx or PIL were
+    imported, which a headless import must not do.
+    """
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [package, env.get("PYTHONPATH")]))
+    times = []
+    heavy = False
+    for run in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", startup_script], env=env)
+        seconds, loaded = output.split()
+        times.append(float(seconds))
+        heavy = heavy or loaded == b"1"
+    seconds = sorted(times)[len(times) // 2]
+    return {"name": "startup", "count": 1, "seconds": round(seconds, 4),
+            "per_second": round(1 / seconds, 1) if seconds else None,
+            "peak_memory_kb": None, "bytes_written": None,
+            "target": startup_target, "heavy_imports": heavy}
+
+
+def read_tags(tagger):
+    for file_id in tagger.get_ids():
+        for key in ["artist", "album", "title", "genre", "tracknumber"]:
+            tagger.read_single(file_id, key)
+
+
+def read_images(tagger):
+    for file_id in tagger.get_ids():
+        tagger.read_single(file_id, "image")
+
+
+def overlay_images(pictures):
+    fg = os.path.join(images_dir, "default.png")
+    mask = os.path.join(images_dir, "mask.png")
+    for picture in pictures:
+        os.remove(image.overlay(fg, picture.name, mask))
+
+
+def render_images(pictures):
+    compositor = image.Compositor(os.path.join(images_dir, "default.png"),
+                                  os.path.join(images_dir, "mask.png"))
+    for picture in pictures:
+        compositor.get_rgba(picture)
+
+
+def run(root, workers=1):
+    """Runs all benchmarks on the corpus below root, which is modified on the way."""
+    results = [measure_startup()]
+    tagger = Tagger(workers=workers)
+    results.append(measure("add_dir", len(tagger.scan(root)), tagger.add_dir, root))
+    results.append(measure("add_dir_tags", len(tagger.scan(root)),
+                           Tagger(workers=workers, tags_only=True).add_dir, root))
+    files = len(tagger.files)
+    results.append(measure("read_single", files * 5, read_tags, tagger))
+    results.append(measure("write_all", files, tagger.write_all, "album", "Benchmarked"))
+    results.append(measure("save_all", files, tagger.save_all))
+    results.append(measure("read_image", files, read_images, tagger))
+    pictures = []
+    for file_id in tagger.get_ids():
+        pictures.extend(tagger.read_single(file_id, "image").values())
+    results.append(measure("image.overlay", len(pictures), overlay_images, pictures))
+    results.append(measure("Compositor", len(pictures), render_images, pictures))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Tagger on a synthetic corpus.")
+    parser.add_argument("--files", type=int, default=300, help="number of files to generate")
+    parser.add_argument("--formats", default="mp3,flac,ogg", help="comma separated formats")
+    parser.add_argument("--seconds", type=int, default=5, help="audio length of every file")
+    parser.add_argument("--tag-size", type=int, default=256, help="bytes of comment per file")
+    parser.add_argument("--cover-size", type=int, default=500, help="cover edge in pixels, 0 for none")
+    parser.add_argument("--workers", type=int, default=1, help="workers for loading")
+    parser.add_argument("--corpus", help="keep the corpus in this directory instead of a tempdir")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args(argv)
+    root = args.corpus or tempfile.mkdtemp(prefix="pyd3tagger-bench-")
+    try:
+        make_corpus(root, args.files, args.formats.split(","), args.seconds, args.tag_size, args.cover_size)
+        results = run(root, args.workers)
+    finally:
+        if not args.corpus:
+            shutil.rmtree(root)
+    for result in results:
+        if args.json:
+            print(json.dumps(result, sort_keys=True))
+        else:
+            line = "%-16s %7d ops %9.4f s %10s ops/s %10s kB peak %12s bytes written" % (
+                result["name"], result["count"], result["seconds"], result["per_second"],
+                result["peak_memory_kb"], result["bytes_written"])
+            if "target" in result:
+                line += " (target %g s%s%s)" % (
+                    result["target"], ", missed" if result["seconds"] > result["target"] else "",
+                    ", imports wx or PIL" if result["heavy_imports"] else "")
+            print(line)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import threading
+
+
+class ChangeNotifier(object):
+    """Collects changed (file_id, key) pairs and reports them to listeners in batches.
+
+    Listeners are called with a dictionary mapping file ids to sets of
+    changed keys, None stands for the whole file. Changes within window
+    seconds of the first one are coalesced into one batch, which is then
+    delivered from a timer thread. With a window of 0 every change is
+    delivered right away.
+    """
+
+    def __init__(self, window=0.0):
+        self.window = window
+        self.listeners = []
+        self.pending = {}
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        self.listeners.remove(callback)
+
+    def notify(self, file_id, key=None):
+        """Records a change, nothing is collected while nobody listens."""
+        if not self.listeners:
+            return
+        with self.lock:
+            self.pending.setdefault(file_id, set()).add(key)
+            if self.window > 0:
+                if self.timer is None:
+                    self.timer = threading.Timer(self.window, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        """Delivers all pending changes immediately."""
+        with self.lock:
+            changes = self.pending
+            self.pending = {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if changes:
+            for callback in list(self.listeners):
+                callback(changes)
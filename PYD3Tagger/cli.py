@@ -1,2 +1,203 @@
+"""Headless bulk tagging: applies a set of tag rules to a whole directory tree.
 
-#TODO: commandline interface
+Rules are read from a JSON list of objects or a CSV file with a header,
+both using the fields action, key, value, source, pattern and match:
+
+  set    Sets key to value.
+  clear  Removes key.
+  copy   Copies the value of the key source to key, or, given a regular
+         expression pattern, sets every named group matched in the path.
+
+A rule only applies to paths matching the optional glob in match.
+"""
+import argparse
+import collections
+import csv
+import fnmatch
+import json
+import os
+import re
+import sys
+import time
+from PYD3Tagger.tagger import Padding, Tagger, load_futures, save_atomic
+
+
+class Rule(object):
+    """A single change to be applied to every matching file."""
+
+    actions = ["set", "clear", "copy"]
+
+    def __init__(self, action, key=None, value="", source=None, pattern=None, match=None):
+        if action not in self.actions:
+            raise ValueError("Unknown rule action: %r" % action)
+        if action == "copy" and not (source or pattern):
+            raise ValueError("copy rules need a source key or a path pattern")
+        if action != "copy" or not pattern:
+            if not key:
+                raise ValueError("%s rules need a key" % action)
+        self.action = action
+        self.key = key
+        self.value = value
+        self.source = source
+        self.pattern = re.compile(pattern) if pattern else None
+        self.match = match
+
+    def applies(self, path):
+        return not self.match or fnmatch.fnmatch(path, self.match)
+
+    def get_values(self, tagger, file_id):
+        """Returns a dictionary of the values this rule writes, None clears a key."""
+        if self.action == "set":
+            return {self.key: self.value}
+        elif self.action == "clear":
+            return {self.key: None}
+        elif self.source:
+            values = tagger.read_all(file_id)
+            if self.source not in values:
+                # A missing source must not write an empty value.
+                return {}
+            return {self.key: list(values[self.source])}
+        # Paths are matched with forward slashes on every platform.
+        found = self.pattern.search(tagger.get_path(file_id).replace(os.sep, "/"))
+        if found is None:
+            return {}
+        values = found.groupdict()
+        if self.key:
+            values = {self.key: values.get(self.key)}
+        return dict((key, value) for key, value in values.items() if value is not None)
+
+
+def load_rules(path):
+    """Reads rules from a .json or .csv file."""
+    with open(path) as handle:
+        if path.lower().endswith(".csv"):
+            # Empty CSV cells are treated like absent fields.
+            entries = [dict((field, value) for field, value in row.items() if value)
+                       for row in csv.DictReader(handle)]
+        else:
+            entries = json.load(handle)
+    return [Rule(**dict((str(field), value) for field, value in entry.items())) for entry in entries]
+
+
+class BatchJob(object):
+    """Streams a tree through the Tagger, applies rules and saves changed files.
+
+    Files are parsed and saved on pools of the given size and dropped
+    from memory right after, so trees of any size can be processed.
+    Changed files are replaced atomically, tags are written with the
+    given Padding policy. With dry_run nothing is saved.
+    """
+
+    def __init__(self, rules, workers=4, dry_run=False, out=None, padding=None):
+        self.rules = rules
+        self.workers = workers
+        self.dry_run = dry_run
+        self.padding = padding if padding is not None else Padding()
+        # Per-file change records are written as JSON lines if a stream is given.
+        self.out = out
+
+    def apply(self, tagger, file_id):
+        """Applies all rules to a file, returns {key: [old, new]} for changed keys."""
+        path = tagger.get_path(file_id)
+        changes = {}
+        for rule in self.rules:
+            if not rule.applies(path):
+                continue
+            for key, value in rule.get_values(tagger, file_id).items():
+                old = changes[key][0] if key in changes else list(tagger.read_single(file_id, key))
+                if value is None:
+                    tagger.clear_single(file_id, key)
+                else:
+                    tagger.write_single(file_id, key, value)
+                changes[key] = [old, list(tagger.read_single(file_id, key))]
+        return dict((key, change) for key, change in changes.items() if change[0] != change[1])
+
+    def run(self, root):
+        """Processes a directory tree and returns a summary dictionary."""
+        started = time.time()
+        summary = collections.OrderedDict([("files_scanned", 0), ("files_changed", 0),
+                                           ("files_failed", 0), ("bytes_written", 0),
+                                           ("bytes_moved", 0), ("elapsed", 0.0),
+                                           ("dry_run", self.dry_run)])
+        tagger = Tagger(workers=self.workers, padding=self.padding)
+        executor = None
+        futures = load_futures() if self.workers > 1 else None
+        if futures is not None:
+            executor = futures.ThreadPoolExecutor(max_workers=self.workers)
+        pending = collections.deque()
+        try:
+            for file_id, media in tagger.iter_dir(root, resident=False):
+                summary["files_scanned"] += 1
+                try:
+                    changes = self.apply(tagger, file_id)
+                except (KeyError, ValueError) as error:
+                    # The file's tags cannot hold a value of the rules, it is left untouched.
+                    summary["files_failed"] += 1
+                    self.report({"path": media.path, "error": str(error)})
+                    continue
+                # Values rewritten with what the file holds already leave it unchanged.
+                if not changes:
+                    continue
+                summary["files_changed"] += 1
+                self.report({"path": media.path, "changes": changes})
+                if self.dry_run:
+                    continue
+                if executor is None:
+                    pending.append((media, None))
+                else:
+                    pending.append((media, executor.submit(save_atomic, media, self.padding)))
+                # Only a few saves are queued, finished files are released right away.
+                while len(pending) > self.workers:
+                    self.collect(pending.popleft(), summary)
+            while pending:
+                self.collect(pending.popleft(), summary)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        for path, error in tagger.errors:
+            summary["files_failed"] += 1
+            self.report({"path": path, "error": str(error)})
+        summary["elapsed"] = round(time.time() - started, 3)
+        return summary
+
+    def collect(self, job, summary):
+        """Waits for a queued save and accounts for its result."""
+        media, result = job
+        try:
+            if result is None:
+                saved = save_atomic(media, self.padding)
+            else:
+                saved = result.result()
+        except Exception as error:
+            summary["files_failed"] += 1
+            self.report({"path": media.path, "error": str(error)})
+            return
+        media.release()
+        summary["bytes_written"] += saved.bytes_written
+        summary["bytes_moved"] += saved.bytes_moved
+
+    def report(self, record):
+        if self.out is not None:
+            self.out.write(json.dumps(record) + "\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply tag rules to a directory tree.")
+    parser.add_argument("rules", help="JSON or CSV file with tag rules")
+    parser.add_argument("directory", help="root of the tree to tag")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="report changes without saving")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="parallel parsing and saving")
+    parser.add_argument("-v", "--verbose", action="store_true", help="list every change and error")
+    args = parser.parse_args(argv)
+    try:
+        rules = load_rules(args.rules)
+    except (IOError, ValueError, TypeError) as error:
+        parser.error("invalid rules: %s" % error)
+    job = BatchJob(rules, args.workers, args.dry_run, sys.stdout if args.verbose else None)
+    summary = job.run(args.directory)
+    # The summary is always the last line written, as a single JSON object.
+    sys.stdout.write(json.dumps({"summary": summary}) + "\n")
+    return 1 if summary["files_failed"] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
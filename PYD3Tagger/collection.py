@@ -0,0 +1,161 @@
+class FileCollection(object):
+    """The files of a Tagger, keyed by stable ids and kept in an explicit order.
+
+    It behaves like a dictionary of ids to MediaFiles that iterates in
+    order. Secondary indexes map every value of the indexed keys to the ids
+    of the files carrying it, files without a value are indexed under "".
+    Tag values have to be changed through set_tag to keep them current.
+    """
+
+    def __init__(self, indexed_keys=()):
+        self.records = {}
+        self.order = []
+        # Maps ids to positions, rebuilt lazily after the order changed.
+        self.positions = {}
+        self.indexes = dict((key, {}) for key in indexed_keys)
+        # The lowest id never used so far, ids of removed files are not given out again.
+        self.next_id = 0
+
+    def __getitem__(self, file_id):
+        return self.records[file_id]
+
+    def __setitem__(self, file_id, media):
+        if file_id in self.records:
+            self.unindex(file_id)
+        else:
+            self.order.append(file_id)
+            self.next_id = max(self.next_id, file_id + 1)
+            if self.positions is not None:
+                self.positions[file_id] = len(self.order) - 1
+        self.records[file_id] = media
+        self.index(file_id)
+
+    def __delitem__(self, file_id):
+        self.unindex(file_id)
+        del self.records[file_id]
+        self.order.remove(file_id)
+        self.positions = None
+
+    def __contains__(self, file_id):
+        return file_id in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(list(self.order))
+
+    def keys(self):
+        return list(self.order)
+
+    def values(self):
+        return [self.records[file_id] for file_id in self.order]
+
+    def items(self):
+        return [(file_id, self.records[file_id]) for file_id in self.order]
+
+    def get_id(self, position):
+        """Returns the id of the file at the given position."""
+        return self.order[position]
+
+    def get_position(self, file_id):
+        """Returns the position of the file with the given id."""
+        if self.positions is None:
+            self.positions = dict((file_id, position) for (position, file_id) in enumerate(self.order))
+        return self.positions[file_id]
+
+    def move(self, file_id, position):
+        """Moves a file to another position, its id stays the same."""
+        self.order.remove(file_id)
+        self.order.insert(position, file_id)
+        self.positions = None
+
+    def sort(self, key="path"):
+        """Orders the files by the first value of a tag, "path" by default."""
+        if key == "path":
+            self.order.sort(key=lambda file_id: self.records[file_id].path)
+        else:
+            self.order.sort(key=lambda file_id: self.records[file_id].simple.get(key, [""])[0])
+        self.positions = None
+
+    def swap(self, id1, id2):
+        """Exchanges the positions of two files, their ids stay the same."""
+        position1 = self.get_position(id1)
+        position2 = self.get_position(id2)
+        self.order[position1], self.order[position2] = id2, id1
+        self.positions = None
+
+    def set_tag(self, file_id, key, values):
+        """Changes the values of a tag in a file, None removes the tag."""
+        indexed = key in self.indexes
+        if indexed:
+            self.unindex_key(file_id, key)
+        tags = self.records[file_id].simple
+        if values is None:
+            tags.pop(key, None)
+        else:
+            tags[key] = values
+        if indexed:
+            self.index_key(file_id, key)
+
+    def get_values(self, file_id, key):
+        return set(self.records[file_id].simple.get(key) or [""])
+
+    def index(self, file_id):
+        for key in self.indexes:
+            self.index_key(file_id, key)
+
+    def unindex(self, file_id):
+        for key in self.indexes:
+            self.unindex_key(file_id, key)
+
+    def index_key(self, file_id, key):
+        for value in self.get_values(file_id, key):
+            self.indexes[key].setdefault(value, set()).add(file_id)
+
+    def unindex_key(self, file_id, key):
+        index = self.indexes[key]
+        for value in self.get_values(file_id, key):
+            ids = index.get(value)
+            if ids is not None:
+                ids.discard(file_id)
+                if not ids:
+                    del index[value]
+
+    def in_order(self, ids):
+        """Sorts a set of ids by position."""
+        return sorted(ids, key=self.get_position)
+
+    def find(self, **criteria):
+        """Returns the ids of all files with the given tag values, in order.
+
+        Indexed keys are looked up directly, only the candidates found that
+        way are checked for the remaining keys. Use "" for missing tags.
+        """
+        candidates = None
+        unindexed = []
+        for key, value in criteria.items():
+            if key in self.indexes:
+                ids = self.indexes[key].get(value, set())
+                if candidates is None:
+                    candidates = set(ids)
+                else:
+                    candidates &= ids
+            else:
+                unindexed.append((key, value))
+        if candidates is None:
+            candidates = self.records.keys()
+        matches = [file_id for file_id in candidates
+                   if all(value in self.get_values(file_id, key) for (key, value) in unindexed)]
+        return self.in_order(matches)
+
+    def group_by(self, key):
+        """Returns a dictionary of every value of a tag to the ids of its files, in order."""
+        if key in self.indexes:
+            groups = self.indexes[key]
+        else:
+            groups = {}
+            for file_id in self.records:
+                for value in self.get_values(file_id, key):
+                    groups.setdefault(value, set()).add(file_id)
+        return dict((value, self.in_order(ids)) for (value, ids) in groups.items())
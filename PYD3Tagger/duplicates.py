@@ -0,0 +1,176 @@
+"""Hashes of the audio payload of files, to find the same track under several paths.
+
+Only the audio is hashed, tags are skipped so retagging a file does not
+change its hash:
+
+  ID3, APE  ID3v2 tags in front, ID3v1 and APEv2 tags at the end of any file
+  FLAC      all metadata blocks, including comments and pictures
+  Ogg       page headers and the header packets of Vorbis, Opus and Speex
+  MP4       everything but the mdat atoms
+
+Other formats are hashed as a whole, apart from the tags above.
+"""
+import hashlib
+import mmap
+import os
+import struct
+
+# Bytes passed to the hash at once, to keep copies out of the mapped file small.
+chunk_size = 1024 * 1024
+
+# Number of header packets in front of the audio of Ogg streams, by the start of the first packet.
+ogg_headers = [(b"\x01vorbis", 3), (b"OpusHead", 2), (b"Speex   ", 2)]
+
+
+def id3v2_size(data, offset):
+    """Returns the size of an ID3v2 tag starting at offset, 0 if there is none."""
+    header = data[offset:offset+10]
+    if len(header) < 10 or header[0:3] != b"ID3":
+        return 0
+    size = 0
+    for byte in bytearray(header[6:10]):
+        # The size is stored in 7 bit bytes, so it never contains a frame sync.
+        size = size << 7 | byte & 0x7f
+    # A footer is present if flag 0x10 is set.
+    return 10 + size + (10 if bytearray(header[5:6])[0] & 0x10 else 0)
+
+
+def tags_end(data, start, end):
+    """Returns where the ID3v1 and APEv2 tags at the end of the data begin."""
+    while True:
+        if end - start >= 128 and data[end-128:end-125] == b"TAG":
+            end -= 128
+        elif end - start >= 32 and data[end-32:end-24] == b"APETAGEX":
+            size, flags = struct.unpack("<4xI4xI", data[end-24:end-8])
+            # The size covers items and footer, a header is flagged in the highest bit.
+            end = max(end - size - (32 if flags & 0x80000000 else 0), start)
+        else:
+            return end
+
+
+def flac_ranges(data, start, end):
+    position = start + 4
+    while position + 4 <= end:
+        header = bytearray(data[position:position+1])[0]
+        size = struct.unpack(">I", b"\x00" + data[position+1:position+4])[0]
+        position += 4 + size
+        if header & 0x80:
+            # The last metadata block is followed by the audio frames.
+            break
+    return [(min(position, end), end)]
+
+
+def ogg_ranges(data, start, end):
+    ranges = []
+    headers = None
+    position = start
+    while position + 27 <= end and data[position:position+4] == b"OggS":
+        segments = bytearray(data[position+26:position+27])[0]
+        table = bytearray(data[position+27:position+27+segments])
+        body = position + 27 + segments
+        if headers is None:
+            # Unknown codecs are hashed without their page headers only.
+            headers = 0
+            for marker, count in ogg_headers:
+                if data[body:body+len(marker)] == marker:
+                    headers = count
+        offset = body
+        for lacing in table:
+            if headers > 0:
+                offset += lacing
+                # A lacing value below 255 ends a packet.
+                if lacing < 255:
+                    headers -= 1
+            else:
+                break
+        page_end = body + sum(table)
+        # Page headers are skipped, their sequence numbers change when tags are rewritten.
+        if offset < page_end:
+            ranges.append((offset, min(page_end, end)))
+        position = page_end
+    return ranges
+
+
+def mp4_ranges(data, start, end):
+    ranges = []
+    position = start
+    while position + 8 <= end:
+        size, kind = struct.unpack(">I4s", data[position:position+8])
+        header = 8
+        if size == 1:
+            # A 64 bit size follows, truncated files may end before it.
+            if position + 16 > end:
+                break
+            size = struct.unpack(">Q", data[position+8:position+16])[0]
+            header = 16
+        elif size == 0:
+            size = end - position
+        if size < header:
+            break
+        if kind == b"mdat":
+            ranges.append((position + header, min(position + size, end)))
+        position += size
+    return ranges or [(start, end)]
+
+
+def audio_ranges(data):
+    """Returns the (start, end) ranges of the audio payload in the data of a file."""
+    start = 0
+    size = id3v2_size(data, start)
+    while size:
+        start += size
+        size = id3v2_size(data, start)
+    end = max(tags_end(data, start, len(data)), start)
+    head = data[start:start+8]
+    if head[0:4] == b"fLaC":
+        return flac_ranges(data, start, end)
+    elif head[0:4] == b"OggS":
+        return ogg_ranges(data, start, end)
+    elif head[4:8] == b"ftyp":
+        return mp4_ranges(data, start, end)
+    return [(start, end)]
+
+
+def hash_audio(path):
+    """Returns the SHA-1 hex digest of the audio payload of a file."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as handle:
+        if os.fstat(handle.fileno()).st_size == 0:
+            return digest.hexdigest()
+        # The file is mapped instead of read, only the pages hashed are ever loaded.
+        data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for start, end in audio_ranges(data):
+                for offset in range(start, end, chunk_size):
+                    digest.update(data[offset:min(offset + chunk_size, end)])
+        finally:
+            data.close()
+    return digest.hexdigest()
+
+
+class HashCache(object):
+    """Audio hashes by path, valid as long as size and mtime of the file match.
+
+    Hashes are kept in memory and, given a TagIndex, across sessions.
+    """
+
+    def __init__(self, index=None):
+        self.index = index
+        self.hashes = {}
+
+    def get(self, path, signature):
+        """Returns the hash of a file with the given (size, mtime) or None."""
+        cached = self.hashes.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        if self.index is not None:
+            digest = self.index.lookup_hash(path, signature)
+            if digest is not None:
+                self.hashes[path] = (signature, digest)
+            return digest
+        return None
+
+    def put(self, path, signature, digest):
+        self.hashes[path] = (signature, digest)
+        if self.index is not None:
+            self.index.store_hash(path, signature, digest)
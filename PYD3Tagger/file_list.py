@@ -0,0 +1,49 @@
+import wx
+
+
+class FileList(wx.ListCtrl):
+    """Virtual list of the files in the model.
+
+    Rows are not stored in the control, their text is read from the model
+    only when a row is drawn. Column widths are computed once per file set.
+    """
+
+    columns = [("#", "tracknumber"), ("Artist", "artist"), ("Album", "album"),
+               ("Title", "title"), ("Path", "path")]
+    # Number of rows measured to find the column widths.
+    sample_rows = 200
+    padding = 16
+
+    def __init__(self, parent, tagger, size=(630, 200)):
+        wx.ListCtrl.__init__(self, parent, style=wx.LC_REPORT|wx.LC_VIRTUAL, size=size)
+        self.tagger = tagger
+        for (i, (title, key)) in enumerate(self.columns):
+            self.InsertColumn(i, title)
+
+    def OnGetItemText(self, item, column):
+        """Called by wx for every visible cell."""
+        return self.tagger.read_single(self.tagger.get_id(item), self.columns[column][1])[0]
+
+    def refill(self):
+        """Adapts the list to a new or reordered set of files."""
+        self.SetItemCount(len(self.tagger.files))
+        self.fit_columns()
+        self.Refresh()
+
+    def refresh_rows(self, rows):
+        """Redraws only the given rows, e.g. after their tags were changed."""
+        count = self.GetItemCount()
+        for row in rows:
+            if 0 <= row < count:
+                self.RefreshItem(row)
+
+    def fit_columns(self):
+        """Sizes the columns to their content."""
+        # LIST_AUTOSIZE does not work for virtual lists, so the widths are
+        # measured on a sample of rows instead of every single one.
+        rows = min(self.GetItemCount(), self.sample_rows)
+        for (i, (title, key)) in enumerate(self.columns):
+            width = self.GetTextExtent(title)[0]
+            for row in range(0, rows):
+                width = max(width, self.GetTextExtent(self.OnGetItemText(row, i))[0])
+            self.SetColumnWidth(i, width + self.padding)
@@ -1,7 +1,8 @@
 # -*- coding: utf-8
 import os
 import wx
-from PYD3Tagger.image import overlay
+from PYD3Tagger.file_list import FileList
+from PYD3Tagger.jobs import EVT_JOB_DONE, EVT_JOB_PROGRESS, Job
 from PYD3Tagger.tagger import Tagger
 from PYD3Tagger.tag_widgets import *
 
@@ -19,11 +20,18 @@ class TagEditor(wx.Frame):
         wx.Frame.__init__(self, parent, title=title, style=wx.DEFAULT_FRAME_STYLE ^ wx.RESIZE_BORDER)
         icon = wx.Icon("tag.png", wx.BITMAP_TYPE_PNG)
         self.SetIcon(icon)
-        self.tagger = Tagger()
+        # Bursts of edits, e.g. while typing, reach the views as a single batch.
+        self.tagger = Tagger(debounce=0.05)
+        self.tagger.subscribe(self.model_changed)
         self.tags = {}
         self.dirname = ''
         self.cur_id = 0
         self.selected_tags = self.default_tags
+        # Loading and saving run as background jobs, one at a time.
+        self.job = None
+        self.progress = None
+        self.Bind(EVT_JOB_PROGRESS, self.job_progress)
+        self.Bind(EVT_JOB_DONE, self.job_done)
 
         # Basically, the Program consists of three main regions:
         # | Menu     |
@@ -66,29 +74,42 @@ class TagEditor(wx.Frame):
         self.SetMenuBar(menubar)
  
     def fill_editor(self, initial=False):
-        """Replaces the tag editor contents with updated values or a different set of widgets."""
-        self.editpane.Clear(True) # We have to clear old elements before adding new ones
+        """Binds the tag editor widgets to the current file and fills in its values.
 
+        Returns True if the editor layout changed.
+        """
+        relayout = False
         # We only show a subset of the ID3/Ogg/Flac-Metadata to keep things simple.
         # TODO: Add Setting for available tag types
-        row = 0
-        for tag_type in self.selected_tags:
-            if tag_type != "image" or not self.tagger.get_ids() or self.tagger.get_type(self.cur_id) == "mp3":
+        if not self.tags:
+            # Widgets are created and placed once, later selections only rebind them.
+            row = 0
+            for tag_type in self.selected_tags:
                 tag = TagFactory.create_tag(self, tag_type, self.tagger, self.cur_id) 
                 widgets = tag.get_widgets(self.mainpane)
                 row = tag.place_widgets(widgets, self.editpane, row)
                 self.tags[tag_type] = tag
-                if self.tagger.get_ids():
-                    tag.fill()
+            relayout = True
+        for tag_type in self.selected_tags:
+            tag = self.tags[tag_type]
+            tag.bind(self.cur_id)
+            visible = tag_type != "image" or not self.tagger.get_ids() or self.tagger.supports_pictures(self.cur_id)
+            if tag.show(visible):
+                relayout = True
+            if visible and self.tagger.get_ids():
+                tag.fill()
+        if relayout:
+            self.editpane.Layout()
 
         # When we first initialize the Widgets there is no file to edit, so widgets are greyed out.
         children = self.GetChildren()
         for child in children:
             child.Enable(not initial)
             self.menubar.action_save.Enable(not initial)
+        return relayout
 
     def filelist(self, main, refresh=False):
-        # TODO: Refactor into wx.ListCtrl subclass together with swapup, -down, etc.
+        # TODO: Move swapup, -down, etc. into the FileList subclass.
         # TODO: Drag and Drop Support for reordering
         """Adds a tabular list structure for the file selection."""
         up = wx.Button(main, label="Up")
@@ -101,9 +122,7 @@ class TagEditor(wx.Frame):
         listbuttons.Add(down, 0, wx.ALIGN_RIGHT|wx.ALL, 5)
 
         listsizer.Add(listbuttons, 0, wx.ALIGN_RIGHT)
-        filelist = wx.ListCtrl(main, style=wx.LC_REPORT, size=(630, 200))
-        for (i, title) in enumerate(["#", "Artist", "Album", "Title", "Path"]):
-            filelist.InsertColumn(i, title)
+        filelist = FileList(main, self.tagger, size=(630, 200))
         self.filelist = filelist
         listsizer.Add(filelist, 1, wx.EXPAND|wx.ALL, 0)
 
@@ -112,34 +131,49 @@ class TagEditor(wx.Frame):
 
     def swapup(self, event):
         """Swap list items upwards."""
-        items = self.get_selection()
+        items = self.get_selected_rows()
         for item in items:
             if item-1 >= 0:
-                self.tagger.swap(item, item-1)
-        self.refresh("list")
+                self.tagger.swap(self.tagger.get_id(item), self.tagger.get_id(item-1))
+                self.move_selection(item, item-1)
 
     def swapdown(self, event):
         """Bubble list items down."""
-        items = self.get_selection()[::-1]
+        items = self.get_selected_rows()[::-1]
         for item in items:
             if item+1 < len(self.tagger.get_ids()):
-                self.tagger.swap(item, item+1)
-        self.refresh("list")
+                self.tagger.swap(self.tagger.get_id(item), self.tagger.get_id(item+1))
+                self.move_selection(item, item+1)
+
+    def move_selection(self, old_row, new_row):
+        """Keeps a file selected after it moved to another row."""
+        self.filelist.Select(old_row, False)
+        self.filelist.Select(new_row, True)
 
     def fill_filelist(self):
         """Change or exchange the entries in the file list."""
-        for file_id in self.tagger.get_ids():
-            tracknumber = self.tagger.read_single(file_id, "tracknumber")[0]
-            if self.filelist.GetItemCount() > file_id:
-                self.filelist.SetStringItem(file_id, 0, tracknumber)
-            else:
-                self.filelist.InsertStringItem(file_id, tracknumber)
-            for (i, tag) in enumerate(["artist", "album", "title", "path"]):
-                self.filelist.SetStringItem(file_id, i+1, self.tagger.read_single(file_id, tag)[0])
-        for i in range(0, self.filelist.GetColumnCount()):
-            self.filelist.SetColumnWidth(i, wx.LIST_AUTOSIZE)
+        # The list is virtual, rows are read from the model when they are drawn.
+        self.filelist.refill()
 
-    def get_selection(self):
+    def refresh_files(self, file_ids):
+        """Redraw only the list rows of files whose tags changed."""
+        self.filelist.refresh_rows([self.tagger.get_position(file_id) for file_id in file_ids
+                                    if file_id in self.tagger.files])
+
+    def model_changed(self, changes):
+        """Receives batches of changes from the model, possibly on a timer thread."""
+        wx.CallAfter(self.update_views, changes)
+
+    def update_views(self, changes):
+        """Updates the list rows and editor widgets affected by a batch of changes."""
+        self.refresh_files(changes.keys())
+        if self.cur_id in changes:
+            keys = changes[self.cur_id]
+            for tag_type, tag in self.tags.items():
+                if None in keys or tag_type in keys:
+                    tag.update()
+
+    def get_selected_rows(self):
         """Retrieve the list items that are currently selected."""
         selection = []
         selected = self.filelist.GetFirstSelected(self)
@@ -148,21 +182,30 @@ class TagEditor(wx.Frame):
             selected = self.filelist.GetNextSelected(selected)
         return selection
 
+    def get_selection(self):
+        """Retrieve the ids of the files that are currently selected."""
+        return [self.tagger.get_id(row) for row in self.get_selected_rows()]
+
     def select_file(self, event):
         """Change the currently edited file to the selected one."""
-        self.cur_id = event.GetIndex()   
+        self.cur_id = self.tagger.get_id(event.GetIndex())
         self.refresh("editor")
 
     def refresh(self, type):  
         """Redraw and refill parts of the application."""
+        relayout = True
         if type in ["editor", "list", "both"]:
             if type != "list":
-                self.fill_editor()
+                relayout = self.fill_editor()
             if type != "editor":
                 self.fill_filelist()
+                relayout = True
             self.Refresh()
-        self.mainpane.SetSizerAndFit(self.mainsizer)
-        self.SetSizeHints(self.GetBestSize().width, self.GetBestSize().height) 
+        # Selecting another file keeps the widgets in place, so the sizers
+        # only have to be fitted again if something was shown or hidden.
+        if relayout:
+            self.mainpane.SetSizerAndFit(self.mainsizer)
+            self.SetSizeHints(self.GetBestSize().width, self.GetBestSize().height) 
          
     def exit(self, event):
         """Exit ;-)"""
@@ -174,8 +217,7 @@ class TagEditor(wx.Frame):
         if dlg.ShowModal() == wx.ID_OK:
             files = dlg.GetPaths()
             self.dirname = dlg.GetDirectory()
-            self.tagger.add_files(files)
-            self.refresh("both")
+            self.start_job("Opening files", self.load_task, None, files)
         dlg.Destroy()
     
     def open_dir(self, event):
@@ -184,14 +226,82 @@ class TagEditor(wx.Frame):
         if dlg.ShowModal() == wx.ID_OK:
             directory = dlg.GetPath()
             self.dirname = directory
-            self.tagger.add_dir(directory)
-            self.refresh("both")
+            self.start_job("Opening folder", self.load_task, directory)
         dlg.Destroy()
 
     def save(self, event):
         """Save the changed to file."""
-        self.tagger.save_all()
+        self.start_job("Saving", self.save_task)
+
+    def load_task(self, job, directory=None, paths=None):
+        """Loads files on the job's thread, they show up in the list as they arrive."""
+        if directory is not None:
+            job.report(0, 0, "Scanning "+directory)
+            paths = self.tagger.scan(directory)
+        loading = self.tagger.iter_files(paths)
+        try:
+            for (done, (file_id, media)) in enumerate(loading):
+                if not job.report(done+1, len(paths), media.path):
+                    break
+        finally:
+            loading.close()
+
+    def save_task(self, job):
+        """Writes all changed files on the job's thread."""
+        # Small edits to large files are written in place instead of copying every file.
+        return self.tagger.save_batch(progress=job.report, atomic=False)
+
+    def start_job(self, title, task, *args):
+        """Runs a task in the background behind a progress dialog that allows cancelling."""
+        # The model must not be edited while a job works on it.
+        self.mainpane.Enable(False)
+        for action in [self.menubar.action_open, self.menubar.action_open_dir, self.menubar.action_save]:
+            action.Enable(False)
+        if task == self.load_task:
+            self.cur_id = 0
+            self.filelist.SetItemCount(0)
+        self.progress = wx.ProgressDialog(title, title, maximum=1000, parent=self,
+                                          style=wx.PD_CAN_ABORT|wx.PD_ELAPSED_TIME)
+        self.job = Job(self, task, *args)
+        self.job.start()
+
+    def job_progress(self, event):
+        """Updates the progress dialog and shows the files loaded so far."""
+        if event.job is not self.job:
+            return
+        self.filelist.SetItemCount(len(self.tagger.files))
+        if event.total:
+            keep_going = self.progress.Update(event.done*1000//event.total, event.message)
+        else:
+            keep_going = self.progress.Pulse(event.message)
+        # Depending on the wx version a flag or a (continue, skip) tuple is returned.
+        if isinstance(keep_going, tuple):
+            keep_going = keep_going[0]
+        if not keep_going:
+            self.job.cancel()
+
+    def job_done(self, event):
+        """Hands the application back to the user once a job has finished."""
+        if event.job is not self.job:
+            return
+        self.progress.Destroy()
+        self.progress = None
+        self.job = None
+        for action in [self.menubar.action_open, self.menubar.action_open_dir]:
+            action.Enable(True)
+        if event.error is not None:
+            wx.MessageBox(str(event.error), "Error", wx.OK|wx.ICON_ERROR, self)
+        elif event.result is not None and event.result.get_failed():
+            wx.MessageBox("%d files could not be saved." % len(event.result.get_failed()),
+                          "Error", wx.OK|wx.ICON_ERROR, self)
+        # Refilling the editor enables the widgets again.
+        self.refresh("both")
+
+
+def main():
+    app = wx.App(False)
+    TagEditor()
+    app.MainLoop()
 
-app = wx.App(False)
-TagEditor()   
-app.MainLoop()
+if __name__ == '__main__':
+    main()
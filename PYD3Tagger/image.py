@@ -1,16 +1,86 @@
+import collections
 from PIL import Image, ImageOps
+from io import BytesIO
+import os
 from tempfile import mkstemp
+import threading
 
-def overlay(fg, bg, mask):
-    """Overlays one image with another one using an alphamask."""
-    bgimg = Image.open(bg)
-    fgimg = Image.open(fg)
-    mask = Image.open(mask)
-    # The background is cropped to fit the masksize.
-    bgimg = ImageOps.fit(bgimg, fgimg.size, method=Image.ANTIALIAS)
+try:
+    from concurrent import futures
+except ImportError:
+    # Without the futures backport (Python 2) thumbnails are rendered sequentially.
+    futures = None
+
+# ANTIALIAS was renamed to LANCZOS in later PIL versions.
+resample = getattr(Image, "LANCZOS", None) or Image.ANTIALIAS
+
+
+def composite(fgimg, bgimg, mask):
+    """Pastes a foreground on a background cropped to its size, using an alphamask."""
+    bgimg = ImageOps.fit(bgimg, fgimg.size, method=resample)
     mergedimg = bgimg.convert("RGBA")
     mergedimg.paste(fgimg, mask)
+    return mergedimg
+
+
+def overlay(fg, bg, mask):
+    """Overlays one image with another one using an alphamask."""
+    mergedimg = composite(Image.open(fg), Image.open(bg), Image.open(mask))
     # Create a temporary file for the image, we won't store it.
     handle, mergedpath = mkstemp(suffix='.png')
+    os.close(handle)
     mergedimg.save(mergedpath)
     return mergedpath
+
+
+class Compositor(object):
+    """Overlays covers with the jewelcase without touching the disk.
+
+    Frame and mask are loaded once, composited covers are memoized by the
+    content hash of the cover, keeping up to max_entries of them.
+    """
+
+    def __init__(self, fg="default.png", mask="mask.png", max_entries=256):
+        self.fgimg = Image.open(fg)
+        self.fgimg.load()
+        self.mask = Image.open(mask)
+        self.mask.load()
+        self.max_entries = max_entries
+        self.rendered = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def render(self, picture):
+        """Returns the composited RGBA image for a Picture."""
+        with self.lock:
+            mergedimg = self.rendered.pop(picture.hash, None)
+            if mergedimg is not None:
+                self.rendered[picture.hash] = mergedimg
+                return mergedimg
+        mergedimg = composite(self.fgimg, Image.open(BytesIO(picture.data)), self.mask)
+        with self.lock:
+            self.rendered[picture.hash] = mergedimg
+            while len(self.rendered) > self.max_entries:
+                self.rendered.popitem(last=False)
+        return mergedimg
+
+    def get_rgba(self, picture):
+        """Returns (width, height, data) with raw RGBA pixels, e.g. for wx.BitmapFromBufferRGBA."""
+        mergedimg = self.render(picture)
+        width, height = mergedimg.size
+        return width, height, mergedimg.tobytes()
+
+    def get_png(self, picture):
+        """Returns the composited cover encoded as PNG."""
+        buf = BytesIO()
+        self.render(picture).save(buf, "PNG")
+        return buf.getvalue()
+
+    def render_all(self, pictures, workers=4):
+        """Pre-renders the covers of a whole album, e.g. before browsing it."""
+        unique = dict((picture.hash, picture) for picture in pictures).values()
+        if workers > 1 and futures is not None:
+            with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(self.render, unique))
+        else:
+            for picture in unique:
+                self.render(picture)
@@ -0,0 +1,113 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class TagIndex(object):
+    """A persistent cache of easy tags, so unchanged files need not be parsed again.
+
+    Entries are keyed on path and only valid as long as size and modification
+    time of the file match. The least recently used entries are evicted once
+    more than max_entries are stored. Hashes of the audio payload are
+    kept alongside, validated the same way.
+    """
+
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # The index may be filled from a worker thread, access is serialized by the lock.
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                               path TEXT PRIMARY KEY,
+                               size INTEGER,
+                               mtime REAL,
+                               type TEXT,
+                               tags TEXT,
+                               used REAL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_used ON files (used)")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS hashes (
+                               path TEXT PRIMARY KEY,
+                               size INTEGER,
+                               mtime REAL,
+                               hash TEXT,
+                               used REAL)""")
+        self.db.commit()
+
+    @staticmethod
+    def signature(path):
+        """Returns the (size, mtime) pair an entry is validated against."""
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+
+    def lookup(self, path):
+        """Returns (type, tags) for an unchanged file or None."""
+        try:
+            size, mtime = self.signature(path)
+        except OSError:
+            return None
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime, type, tags FROM files WHERE path = ?",
+                                  (path,)).fetchone()
+            if row is None:
+                return None
+            if row[0] != size or row[1] != mtime:
+                # The file was changed by someone else, the entry is stale.
+                self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+                return None
+            self.db.execute("UPDATE files SET used = ? WHERE path = ?", (time.time(), path))
+        return row[2], json.loads(row[3])
+
+    def store(self, path, type, tags):
+        """Remembers the easy tags of a freshly parsed or saved file."""
+        try:
+            size, mtime = self.signature(path)
+        except OSError:
+            return
+        tags = json.dumps(dict((key, list(tags[key])) for key in tags.keys()))
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                            (path, size, mtime, type, tags, time.time()))
+
+    def lookup_hash(self, path, signature):
+        """Returns the audio hash stored for a file with the given (size, mtime) or None."""
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime, hash FROM hashes WHERE path = ?",
+                                  (path,)).fetchone()
+            if row is None or (row[0], row[1]) != tuple(signature):
+                return None
+            self.db.execute("UPDATE hashes SET used = ? WHERE path = ?", (time.time(), path))
+        return row[2]
+
+    def store_hash(self, path, signature, digest):
+        """Remembers the audio hash of a file, signature was taken before hashing it."""
+        size, mtime = signature
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)",
+                            (path, size, mtime, digest, time.time()))
+
+    def invalidate(self, path):
+        """Drops the entries for the given path."""
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+            self.db.execute("DELETE FROM hashes WHERE path = ?", (path,))
+
+    def evict(self):
+        """Removes the least recently used entries beyond max_entries."""
+        with self.lock:
+            for table in ["files", "hashes"]:
+                self.db.execute("""DELETE FROM %s WHERE path IN (
+                                       SELECT path FROM %s ORDER BY used DESC
+                                       LIMIT -1 OFFSET ?)""" % (table, table), (self.max_entries,))
+
+    def commit(self):
+        """Enforces the size bound and writes pending changes to disk."""
+        self.evict()
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        self.commit()
+        self.db.close()
@@ -0,0 +1,50 @@
+import threading
+import time
+import wx
+import wx.lib.newevent
+
+# Events posted to the window that started a job, both carry the job itself.
+JobProgressEvent, EVT_JOB_PROGRESS = wx.lib.newevent.NewEvent()
+JobDoneEvent, EVT_JOB_DONE = wx.lib.newevent.NewEvent()
+
+
+class Job(threading.Thread):
+    """Runs a long operation off the main thread so the window stays responsive.
+
+    The task is called with the job as its first argument and reports its
+    progress through job.report(), which returns False once the job was
+    cancelled. Progress and the result are posted to the window as wx events.
+    """
+
+    # Minimum number of seconds between two progress events.
+    interval = 0.1
+
+    def __init__(self, window, task, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.window = window
+        self.task = task
+        self.args = args
+        self.cancelled = threading.Event()
+        self.last_report = 0
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def report(self, done, total, message=""):
+        """Posts progress to the window, throttled to keep the event queue short."""
+        now = time.time()
+        if now - self.last_report >= self.interval or done == total:
+            self.last_report = now
+            wx.PostEvent(self.window, JobProgressEvent(job=self, done=done, total=total, message=message))
+        return not self.cancelled.is_set()
+
+    def run(self):
+        result = None
+        error = None
+        try:
+            result = self.task(self, *self.args)
+        except Exception as exception:
+            error = exception
+        wx.PostEvent(self.window, JobDoneEvent(job=self, result=result, error=error,
+                                               cancelled=self.cancelled.is_set()))
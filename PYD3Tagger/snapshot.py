@@ -0,0 +1,158 @@
+"""Snapshots of the easy tags of all loaded files, for bulk editing outside the Tagger.
+
+Files are identified by their path. A snapshot is written as JSON lines
+or, for files ending in .csv, as CSV:
+
+  JSON lines  One object per file, with its "path" and a list of values
+              for every key. Keys missing from an object are left alone,
+              null or an empty list removes them.
+  CSV         A header of path and the keys, one row per file, in UTF-8.
+              Every cell holds the values as a JSON list, so values may
+              contain newlines and commas. A cell that is no JSON list is
+              taken as a single value, an empty cell removes the key and
+              missing columns are left alone.
+
+Importing a snapshot only changes the values that differ from the loaded
+ones, so only the files actually edited are written.
+"""
+import collections
+import csv
+import io
+import json
+from PYD3Tagger.tagger import check_tag
+
+
+def encode_cell(values):
+    """Returns the CSV cell of a list of values."""
+    return json.dumps(list(values), ensure_ascii=False)
+
+
+def decode_cell(cell):
+    """Returns the list of values of a CSV cell, edited cells may hold a plain single value."""
+    if not cell:
+        return []
+    try:
+        values = json.loads(cell)
+    except ValueError:
+        return [cell]
+    if not isinstance(values, list):
+        return [cell]
+    return [u"%s" % value for value in values]
+
+
+def export(tagger, path, keys=None):
+    """Writes the tags of all files in the Tagger, optionally only the given keys."""
+    records = []
+    for file_id in tagger.get_ids():
+        tags = tagger.read_all(file_id)
+        wanted = sorted(tags.keys()) if keys is None else [key for key in keys if key in tags]
+        records.append((tagger.get_path(file_id), [(key, list(tags[key])) for key in wanted]))
+    # The csv module does its own line endings, and handles quoted newlines only without translation.
+    with io.open(path, "w", newline="", encoding="utf-8") as handle:
+        if path.lower().endswith(".csv"):
+            if keys is None:
+                keys = sorted(set(key for (file_path, tags) in records for (key, values) in tags))
+            writer = csv.writer(handle)
+            writer.writerow(["path"] + list(keys))
+            for file_path, tags in records:
+                tags = dict(tags)
+                writer.writerow([file_path] + [encode_cell(tags[key]) if key in tags else "" for key in keys])
+        else:
+            for file_path, tags in records:
+                handle.write(json.dumps(collections.OrderedDict([("path", file_path)] + tags)) + "\n")
+    return len(records)
+
+
+def read(path):
+    """Reads a snapshot into a list of (path, {key: list of values}) pairs."""
+    records = []
+    with io.open(path, newline="", encoding="utf-8") as handle:
+        if path.lower().endswith(".csv"):
+            for row in csv.DictReader(handle):
+                file_path = row.pop("path")
+                records.append((file_path, dict((key, decode_cell(value)) for key, value in row.items())))
+        else:
+            for line in handle:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                file_path = entry.pop("path")
+                tags = {}
+                for key, value in entry.items():
+                    if value is None:
+                        value = []
+                    elif not isinstance(value, list):
+                        value = [value]
+                    tags[key] = [u"%s" % single for single in value]
+                records.append((file_path, tags))
+    return records
+
+
+class ImportReport(object):
+    """Outcome of importing a snapshot."""
+
+    def __init__(self):
+        # Maps file ids to {key: [old values, new values]} of every changed key.
+        self.changes = collections.OrderedDict()
+        # Paths in the snapshot that are not loaded in the Tagger.
+        self.unknown = []
+        # Maps file ids to the SaveResult of every saved file.
+        self.saves = {}
+        # Maps file ids to the error that kept them from being changed or saved.
+        self.errors = {}
+
+    def __repr__(self):
+        return "<ImportReport %d files changed, %d unknown, %d saved, %d errors>" % (
+            len(self.changes), len(self.unknown), len(self.saves), len(self.errors))
+
+
+def diff(tagger, records):
+    """Compares snapshot records to the loaded files and returns an ImportReport of the differences."""
+    report = ImportReport()
+    ids = dict((tagger.get_path(file_id), file_id) for file_id in tagger.get_ids())
+    for file_path, tags in records:
+        file_id = ids.get(file_path)
+        if file_id is None:
+            report.unknown.append(file_path)
+            continue
+        loaded = tagger.read_all(file_id)
+        changes = {}
+        for key, values in tags.items():
+            old = list(loaded.get(key, []))
+            if old != values:
+                changes[key] = [old, values]
+        if changes:
+            report.changes[file_id] = changes
+    return report
+
+
+def apply(tagger, path, save=True):
+    """Imports a snapshot, writes the differing values and saves the changed files.
+
+    Other files, including those with unrelated unsaved edits, are not
+    saved. Files with values their tags cannot hold are left untouched,
+    they are moved from the changes to the errors of the ImportReport
+    returned, like files that could not be saved.
+    """
+    report = diff(tagger, read(path))
+    for file_id, changes in list(report.changes.items()):
+        try:
+            # Every value is checked first, so a file is changed completely or not at all.
+            for key, (old, new) in changes.items():
+                if new:
+                    check_tag(tagger.get_type(file_id), key, new)
+        except (KeyError, ValueError) as error:
+            del report.changes[file_id]
+            report.errors[file_id] = error
+            continue
+        for key, (old, new) in changes.items():
+            if new:
+                tagger.write_single(file_id, key, new)
+            else:
+                tagger.clear_single(file_id, key)
+        if save:
+            try:
+                report.saves[file_id] = tagger.save_single(file_id)
+            except Exception as error:
+                report.errors[file_id] = error
+    return report
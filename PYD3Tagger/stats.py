@@ -0,0 +1,111 @@
+import heapq
+import threading
+
+
+class OperationStats(object):
+    """Counters, a timing histogram and the slowest files of one kind of operation."""
+
+    # Upper bounds of the histogram buckets in seconds, slower calls land in the last one.
+    buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0]
+
+    def __init__(self, slowest=10):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.histogram = [0] * (len(self.buckets) + 1)
+        self.max_slowest = slowest
+        # A min-heap of (seconds, path), so the fastest of the slowest is dropped first.
+        self.slowest = []
+
+    def add(self, seconds, path=None, bytes_read=0, bytes_written=0):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+        bucket = 0
+        while bucket < len(self.buckets) and seconds > self.buckets[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+        if path is not None:
+            if len(self.slowest) < self.max_slowest:
+                heapq.heappush(self.slowest, (seconds, path))
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, path))
+
+    def snapshot(self):
+        labels = ["<=%g" % bound for bound in self.buckets] + [">%g" % self.buckets[-1]]
+        return {"count": self.count,
+                "seconds": round(self.seconds, 6),
+                "max_seconds": round(self.max_seconds, 6),
+                "bytes_read": self.bytes_read,
+                "bytes_written": self.bytes_written,
+                "histogram": dict(zip(labels, self.histogram)),
+                "slowest": [[round(seconds, 6), path] for (seconds, path) in sorted(self.slowest, reverse=True)]}
+
+
+class Stats(object):
+    """Collects instrumentation of Tagger operations such as scan, parse, image and save.
+
+    Hooks are called with (operation, seconds, path, bytes_read,
+    bytes_written) for every recorded operation, possibly from worker
+    threads. A Tagger without a Stats object skips all instrumentation.
+    """
+
+    def __init__(self, slowest=10):
+        self.slowest = slowest
+        self.operations = {}
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    def add_hook(self, callback):
+        self.hooks.append(callback)
+
+    def remove_hook(self, callback):
+        self.hooks.remove(callback)
+
+    def record(self, operation, seconds, path=None, bytes_read=0, bytes_written=0):
+        with self.lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = OperationStats(self.slowest)
+            stats.add(seconds, path, bytes_read, bytes_written)
+        for callback in self.hooks:
+            callback(operation, seconds, path, bytes_read, bytes_written)
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+    def snapshot(self):
+        """Returns a dictionary of all operations and their statistics."""
+        with self.lock:
+            return dict((operation, stats.snapshot()) for (operation, stats) in self.operations.items())
+
+    def to_json(self):
+        import json
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+
+class CountingFile(object):
+    """Wraps a file object and counts the bytes read and written through it."""
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.name = handle.name
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def read(self, size=-1):
+        data = self.handle.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return self.handle.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.handle, name)
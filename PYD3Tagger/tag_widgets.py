@@ -1,6 +1,5 @@
 import os
 import wx
-from PYD3Tagger.image import overlay
 
 
 class TagFactory(object):
@@ -29,6 +28,19 @@ class Tag(object):
         self.file_id = file_id
         self.file_type = None
 
+    def bind(self, file_id):
+        """Points the existing widgets at another file."""
+        self.file_id = file_id
+
+    def show(self, visible=True):
+        """Shows or hides the widgets, returns True if their visibility changed."""
+        changed = False
+        for widget in self.widgets.values():
+            if widget.IsShown() != visible:
+                widget.Show(visible)
+                changed = True
+        return changed
+
     def get_tagval(self):
         """Reads the tag value from the model."""
         return self.tagger.read_single(self.file_id, self.tag_type)
@@ -37,11 +49,15 @@ class Tag(object):
         """Fills the widget with data from the model."""
         self.widgets['input'].ChangeValue(self.get_tagval()[0])
 
+    def update(self):
+        """Refills the widgets if the model changed behind their back."""
+        if self.widgets['input'].GetValue() != self.get_tagval()[0]:
+            self.fill()
+
     def change(self, value):
         """Keeps track of changes to the widgets and keeps associated widgets consistent."""
         value = self.widgets['input'].GetValue()
         self.tagger.write_single(self.file_id, self.tag_type, value)
-        self.main.refresh("list")
     
     def make_widgets(self, parent):
         """Creates the set of widgets utilized for the tag."""
@@ -76,7 +92,6 @@ class Tag(object):
         selection = self.main.get_selection()
         for file_id in selection:
             self.tagger.write_single(file_id, self.tag_type, self.get_tagval())
-        self.main.refresh("list")
 
 
 class TracknumTag(Tag):
@@ -104,6 +119,11 @@ class TracknumTag(Tag):
         self.widgets['num'].ChangeValue(values[0])
         self.widgets['tot'].ChangeValue(values[1])
 
+    def update(self):
+        shown = self.widgets['num'].GetValue()+"/"+self.widgets['tot'].GetValue()
+        if shown != self.get_tagval()[0]:
+            self.fill()
+
     def change(self, value):
         num = self.widgets['num'].GetValue()
         tot = self.widgets['tot'].GetValue()
@@ -113,11 +133,10 @@ class TracknumTag(Tag):
         """Automatically fill the track numbers in the current selection."""
         selection = self.main.get_selection()
         if not selection:
-            selection = range(0, len(self.tagger.get_ids()))
+            selection = self.tagger.get_ids()
         tot = len(selection)
         for (i, field_id) in enumerate(selection):
             self.tagger.write_single(field_id, "tracknumber", str(i+1)+"/"+str(tot))
-        self.main.refresh("both")
 
     def place_widgets(self, widgets, grid, row):
         grid.Add(self.widgets['label'], pos=(row, 0), span=wx.GBSpan(1,1), flag=wx.ALL|wx.ALIGN_CENTER_VERTICAL) 
@@ -130,32 +149,60 @@ class TracknumTag(Tag):
 class ImageTag(Tag):
     """Tag subclass that provides widgets and functions for embedded images like cover images."""
     apic_name = "Cover (front)"
+    compositor = None
+    default_cover = None
+
+    @classmethod
+    def get_compositor(cls):
+        """The compositor is shared by all image tags, so frame and mask are loaded once."""
+        if cls.compositor is None:
+            # PIL is only imported once a cover is shown.
+            from PYD3Tagger.image import Compositor
+            cls.compositor = Compositor("default.png", "mask.png")
+        return cls.compositor
+
+    @classmethod
+    def get_default_cover(cls):
+        """An empty jewelcase is a placeholder for the cover, it is loaded once."""
+        if cls.default_cover is None:
+            cls.default_cover = wx.Bitmap("default.png")
+        return cls.default_cover
     
     def make_widgets(self, parent):
         widgets = {} 
         widgets['label'] = wx.StaticText(parent, label=self.tag_type.capitalize())
         widgets['browse'] = wx.FilePickerCtrl(parent)
         widgets['browse'].Bind(wx.EVT_FILEPICKER_CHANGED, self.change)
-        cover = wx.Bitmap("default.png") # An empty jewelcase is a placeholder for the cover.
-        widgets['img'] = wx.StaticBitmap(parent, -1, cover)
+        widgets['img'] = wx.StaticBitmap(parent, -1, self.get_default_cover())
         widgets['sync'] = wx.Button(parent, label="Sync")
         widgets['sync'].Bind(wx.EVT_BUTTON, self.sync)
         self.widgets = widgets
 
-    def fill(self):
+    def get_cover(self):
+        """Returns the front cover of the file or None."""
         images = self.tagger.read_single(self.file_id, self.tag_type)
-        if images and self.apic_name in images:
-            bg = images[self.apic_name].name
-            fg = "default.png"
-            mask = "mask.png"
+        if self.apic_name in images:
+            return images[self.apic_name]
+        # Other formats rarely name their covers, the front cover is told by its type.
+        covers = sorted(images.values(), key=lambda picture: picture.type != 3)
+        return covers[0] if covers else None
+
+    def fill(self):
+        cover = self.get_cover()
+        if cover is not None:
             # The Cover Image is overlayed by a jewelcase for some eyecandy.
-            merged = overlay(fg, bg, mask)
-            self.widgets['img'].SetBitmap(wx.Bitmap(merged))
+            width, height, data = self.get_compositor().get_rgba(cover)
+            self.widgets['img'].SetBitmap(wx.BitmapFromBufferRGBA(width, height, data))
+        else:
+            # The widget is reused across files, so a previous cover has to go.
+            self.widgets['img'].SetBitmap(self.get_default_cover())
+
+    def update(self):
+        self.fill()
 
     def change(self, event):
         self.path = event.GetPath()
         self.tagger.write_single(self.file_id, self.tag_type, path=self.path, name=self.apic_name)
-        self.fill()
 
     def place_widgets(self, widgets, grid, row):
         # The image widgets span two rows in the editor, unlike most of the other widgets.
@@ -169,12 +216,7 @@ class ImageTag(Tag):
         selection = self.main.get_selection()
         # Unfortunately the widgets lose their value when the file is switched.
         # Consequently we cannot query the FilePicker widget for the file path.
-        # Instead, the image is read from the 
-        images = self.tagger.read_single(self.file_id, self.tag_type)
-        if images:
-            path = images.values()[0].name
-            for file_id in selection:
-                self.tagger.write_single(file_id, self.tag_type, path=path, name=self.apic_name)
-        self.main.refresh("list")
-
-
+        # Instead, the image is read from the model and shared with the selection.
+        cover = self.get_cover()
+        if cover is not None:
+            self.tagger.write_image(selection, cover, self.apic_name)
@@ -1,54 +1,948 @@
-import imghdr
+import base64
+import collections
+import functools
+import itertools
 import mutagen
-from mutagen import id3
+from mutagen import apev2, asf, easyid3, easymp4, flac, id3, mp3, mp4, ogg, oggflac, oggopus, oggspeex, oggtheora, oggvorbis
 import os
-import tempfile
+import time
+from PYD3Tagger.artwork import ArtworkCache, Picture
+from PYD3Tagger.changes import ChangeNotifier
+from PYD3Tagger.collection import FileCollection
+from PYD3Tagger.stats import CountingFile
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Python 2 needs the scandir backport, otherwise os.walk is used.
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def load_futures():
+    """Returns the concurrent.futures module, imported on first use of a pool."""
+    try:
+        from concurrent import futures
+    except ImportError:
+        # Without the futures backport (Python 2) all work is done sequentially.
+        return None
+    return futures
+
+
+# Extensions of the formats mutagen can handle, files with other extensions are never parsed.
+# mutagen keeps no list of them: these are the extensions its formats check for, and the usual
+# ones of the formats it only recognizes by their header (MP4, Ogg, ASF, WavPack, ...).
+audio_extensions = frozenset([".3g2", ".3gp", ".aac", ".ac3", ".adif", ".adts", ".aif", ".aifc",
+                              ".aiff", ".ape", ".asf", ".dff", ".dsf", ".eac3", ".flac", ".m4a",
+                              ".m4b", ".m4p", ".m4r", ".m4v", ".mid", ".midi", ".mp2", ".mp3",
+                              ".mp4", ".mpc", ".mpeg", ".mpg", ".oga", ".ogg", ".ogv", ".ogx",
+                              ".ofr", ".ofs", ".opus", ".spx", ".tak", ".tta", ".wav", ".wma",
+                              ".wmv", ".wv"])
+
+# Leading bytes of the containers above, used to sniff files before handing them to mutagen.
+# MPEG audio and AAC in ADTS frames start with a frame sync instead, see frame_sync.
+audio_signatures = [(0, b"ID3"), (0, b"fLaC"), (0, b"OggS"), (4, b"ftyp"), (0, b"RIFF"),
+                    (0, b"FORM"), (0, b"MAC "), (0, b"MPCK"), (0, b"MP+"), (0, b"wvpk"),
+                    (0, b"TTA1"), (0, b"OFR "), (0, b"DSD "), (0, b"APETAGEX"), (0, b"tBaK"),
+                    (0, b"FRM8"), (0, b"MThd"), (0, b"ADIF"), (0, b"\x0b\x77"),
+                    (0, b"\x30\x26\xb2\x75\x8e\x66\xcf\x11")]
+
+
+def scan_dir(path):
+    """Yields the paths of all files below a directory."""
+    if scandir is None:
+        for dirpath, dirs, files in os.walk(path):
+            for single_file in files:
+                yield os.path.join(dirpath, single_file)
+        return
+    # scandir gets the entry types from the directory listing itself,
+    # which saves a stat call for every file.
+    pending = [path]
+    while pending:
+        try:
+            entries = list(scandir(pending.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+            else:
+                yield entry.path
+
+
+def file_signature(path):
+    """Returns the (size, mtime) pair used to tell whether a file changed, None if it is gone."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+def frame_sync(head):
+    """Tells whether data starts with an MPEG audio frame sync."""
+    return len(head) >= 2 and head[0:1] == b"\xff" and ord(head[1:2]) & 0xe0 == 0xe0
+
+
+def sniff_audio(path):
+    """Checks the leading bytes of a file for a known audio container."""
+    try:
+        with open(path, "rb") as handle:
+            head = handle.read(16)
+    except IOError:
+        return False
+    # MPEG audio without an ID3 tag starts with a frame sync.
+    if frame_sync(head):
+        return True
+    for offset, signature in audio_signatures:
+        if head[offset:offset+len(signature)] == signature:
+            return True
+    return False
+
+
+def load_file(path):
+    """Parses a file once and returns its complex mutagen object, if any."""
+    if os.path.exists(path):
+        return mutagen.File(path)
+    return None
+
+
+def read_file(path, tags_only=False):
+    """Parses a file and returns its (type, easy tags) or None.
+
+    Only the small tag dictionary leaves this function, so it is cheap to
+    send back from a worker process and the parsed file is freed right away.
+    With tags_only the audio stream is not analysed, see load_tags.
+    """
+    if tags_only:
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as handle:
+            return load_tags(handle)
+    return file_tags(load_file(path))
+
+
+def read_file_measured(path, tags_only=False):
+    """Like read_file, but returns (result, seconds, bytes read) for instrumentation."""
+    started = time.time()
+    if not os.path.exists(path):
+        return None, time.time() - started, 0
+    with open(path, "rb") as handle:
+        counting = CountingFile(handle)
+        if tags_only:
+            parsed = load_tags(counting)
+        else:
+            parsed = file_tags(mutagen.File(counting))
+    return parsed, time.time() - started, counting.bytes_read
+
+
+# Ogg formats whose comment header can be read without the rest of the stream, see load_tags.
+ogg_kinds = [oggflac.OggFLAC, oggopus.OggOpus, oggspeex.OggSpeex, oggtheora.OggTheora, oggvorbis.OggVorbis]
+
+
+def load_tags(handle):
+    """Reads only the tags of an open file and returns its (type, easy tags) or None.
+
+    For MP3 only the ID3 tags are read instead of scanning MPEG frames,
+    for Ogg the comment header instead of seeking to the last page. FLAC
+    keeps its tags in the metadata blocks in front of the audio anyway.
+    Other formats are parsed completely. The audio itself is neither
+    validated nor measured, stream info like length and bitrate has to be
+    parsed separately.
+    """
+    header = handle.read(128)
+    handle.seek(0)
+    # Other formats carrying ID3 tags, like AAC, are told apart by their extension.
+    # Files that are no MPEG audio at all are left to mutagen, which rejects them.
+    if handle.name.lower().endswith(".mp3") and (header[0:3] == b"ID3" or frame_sync(header)):
+        try:
+            tags = id3.ID3(handle)
+        except id3.ID3NoHeaderError:
+            tags = id3.ID3()
+        easy = easyid3.EasyID3()
+        easy._EasyID3__id3 = tags
+        return "mp3", easy_tags(easy)
+    for kind in ogg_kinds:
+        # Ogg streams are identified by the codec header in their first page.
+        if kind.score(handle.name, handle, header) > 0:
+            # The same steps as OggFileType.load, without the length lookup at the end.
+            tags = kind._Tags(handle, kind._Info(handle))
+            return kind.__name__.lower(), easy_tags(tags)
+    return file_tags(mutagen.File(handle))
+
+
+def file_tags(complex):
+    """Returns the (type, easy tags) of a parsed file or None."""
+    if complex is None:
+        return None
+    return complex.__class__.__name__.lower(), easy_tags(easy_view(complex))
+
+
+def easy_tags(easy):
+    """Copies the textual values of an easy interface into a plain dictionary, without pictures."""
+    tags = {}
+    for key in easy.keys():
+        if key.lower() in picture_keys:
+            continue
+        values = text_values(easy[key])
+        if values is not None:
+            tags[key] = values
+    return tags
+
+
+try:
+    text_types = (str, unicode)
+except NameError:
+    text_types = (str,)
+
+
+def text_values(value):
+    """Returns a tag value as a list of strings, None if it is no text.
+
+    Formats without an easy interface, like WAVE or AIFF, hand out their
+    raw ID3 frames or ASF attributes, binary ones like APIC are skipped.
+    """
+    if isinstance(value, id3.TextFrame):
+        value = value.text
+    elif isinstance(value, apev2.APETextValue):
+        value = list(value)
+    elif not isinstance(value, (list, tuple)):
+        value = [value]
+    values = []
+    for item in value:
+        if isinstance(item, asf.ASFUnicodeAttribute):
+            item = item.value
+        elif isinstance(item, id3.ID3TimeStamp):
+            item = item.text
+        if not isinstance(item, text_types):
+            return None
+        values.append(item)
+    return values
+
+
+# Types whose tags are Vorbis comments or APEv2, both restrict the characters of keys.
+vorbis_types = frozenset(["flac", "oggflac", "oggopus", "oggspeex", "oggtheora", "oggvorbis"])
+apev2_types = frozenset(["monkeysaudio", "musepack", "optimfrog", "tak", "wavpack"])
+
+
+def check_tag(type, key, value):
+    """Raises the KeyError or ValueError the easy interface of a file type raises for invalid tags.
+
+    Values are only stored in the tag dictionary until the file is saved,
+    so they are tried on empty tags of the same kind right away instead.
+    """
+    if type == "mp3":
+        tags = easyid3.EasyID3()
+    elif type == "mp4":
+        tags = easymp4.EasyMP4Tags()
+    elif type in vorbis_types:
+        tags = flac.VCFLACDict()
+    elif type in apev2_types:
+        tags = apev2.APEv2()
+    else:
+        return
+    tags[key] = value
+
+
+def easy_view(complex):
+    """Returns an easy interface sharing the tags of an already parsed file."""
+    # mutagen only builds its easy wrappers from a filename, which would mean
+    # parsing the file a second time. Instead the wrapper is attached to the
+    # tags we already have, so both views stay consistent in memory.
+    if isinstance(complex, mp3.MP3):
+        if complex.tags is None:
+            complex.add_tags()
+        easy = easyid3.EasyID3()
+        easy._EasyID3__id3 = complex.tags
+        return easy
+    elif isinstance(complex, mp4.MP4):
+        if complex.tags is None:
+            complex.add_tags()
+        easy = easymp4.EasyMP4Tags()
+        easy._EasyMP4Tags__mp4 = complex.tags
+        easy.load = complex.tags.load
+        easy.save = complex.tags.save
+        easy.delete = complex.tags.delete
+        return easy
+    # Vorbis comments (Ogg, Flac) and APEv2 are already simple dictionaries.
+    return complex
+
+
+class Padding(object):
+    """Padding policy for tag writes, called by mutagen with a PaddingInfo.
+
+    Tags that still fit into the existing padding are written in place,
+    however much padding is left. Otherwise the audio data has to be moved
+    anyway, and headroom bytes, at most max_padding, are reserved so
+    following edits fit again. Excess padding is only given back on such
+    rewrites.
+    """
+
+    def __init__(self, headroom=16384, max_padding=1024*1024):
+        self.headroom = headroom
+        self.max_padding = max_padding
+
+    def __call__(self, info):
+        if info.padding >= 0:
+            return info.padding
+        return min(self.headroom, self.max_padding)
+
+
+# Formats whose save accepts a padding policy.
+padded_types = (id3.ID3FileType, flac.FLAC, mp4.MP4, ogg.OggFileType, asf.ASF)
+
+
+class SaveResult(object):
+    """How a single file was saved.
+
+    in_place is True if only the tag region was rewritten, False if the
+    audio data was moved or copied, and None if the format does not tell.
+    bytes_moved counts the bytes of the file beside the tags that were
+    written again, bytes_written all bytes written to disk, tags and
+    moved data alike. size is the size of the saved file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.in_place = None
+        self.bytes_moved = 0
+        self.bytes_written = 0
+        self.size = 0
+
+    def __repr__(self):
+        return "<SaveResult %s, in place: %s, %d bytes moved>" % (self.path, self.in_place, self.bytes_moved)
+
+
+def save_media(media, padding=None, filename=None):
+    """Saves the changes of a file to its path or filename, returns a SaveResult."""
+    result = SaveResult(media.path)
+    complex = media.apply()
+    # mutagen writes through the file object it is given, so the bytes written can be counted.
+    with open(filename or media.path, "rb+") as handle:
+        counting = CountingFile(handle)
+        if padding is None or not isinstance(complex, padded_types):
+            complex.save(counting)
+        else:
+            # ID3 counts the data following the padding from the start of the old tag.
+            old_tag = complex.tags.size if isinstance(complex.tags, id3.ID3) else 0
+            def record(info):
+                wanted = padding(info)
+                result.in_place = wanted == info.padding
+                result.bytes_moved = 0 if result.in_place else max(info.size - old_tag, 0)
+                return wanted
+            complex.save(counting, padding=record)
+    result.bytes_written = counting.bytes_written
+    result.size = os.path.getsize(filename or media.path)
+    return result
+
+
+# Types of the files pictures can be read from and embedded into.
+picture_types = frozenset(["mp3", "flac", "mp4", "oggflac", "oggopus", "oggspeex", "oggtheora", "oggvorbis"])
+
+# Vorbis comments holding pictures, which are kept out of the easy tags.
+picture_keys = frozenset(["metadata_block_picture", "coverart", "coverartmime"])
+
+mp4_cover_mimes = {mp4.MP4Cover.FORMAT_JPEG: "image/jpeg", mp4.MP4Cover.FORMAT_PNG: "image/png"}
+
+
+def embedded_pictures(complex):
+    """Returns (data, info) for every picture embedded in a parsed file.
+
+    info holds the Picture attributes mime, type, desc and, where the
+    format stores them, width and height.
+    """
+    pictures = []
+    tags = complex.tags
+    if isinstance(complex, flac.FLAC):
+        for block in complex.pictures:
+            pictures.append((block.data, flac_info(block)))
+    elif tags is None:
+        pass
+    elif isinstance(tags, id3.ID3):
+        for frame in tags.getall("APIC"):
+            pictures.append((frame.data, {"mime": frame.mime, "type": int(frame.type), "desc": frame.desc}))
+    elif isinstance(tags, mp4.MP4Tags):
+        for position, cover in enumerate(tags.get("covr", [])):
+            # MP4 covers have neither a type nor a description, the first one is the front cover.
+            pictures.append((bytes(cover), {"mime": mp4_cover_mimes.get(cover.imageformat, ""),
+                                            "type": 3 if position == 0 else 0, "desc": ""}))
+    elif isinstance(complex, ogg.OggFileType):
+        for value in tags.get("metadata_block_picture", []):
+            try:
+                block = flac.Picture(base64.b64decode(value))
+            except (TypeError, ValueError, flac.error):
+                continue
+            pictures.append((block.data, flac_info(block)))
+    return pictures
+
+
+def flac_info(block):
+    return {"mime": block.mime, "type": int(block.type), "desc": block.desc,
+            "width": block.width, "height": block.height}
+
+
+def flac_block(picture, desc):
+    """Returns a FLAC picture block of a Picture, as used by FLAC and Ogg files."""
+    block = flac.Picture()
+    block.type = 3
+    block.mime = picture.mime
+    block.desc = desc
+    block.width = picture.width
+    block.height = picture.height
+    block.data = picture.data
+    return block
+
+
+def encoded_picture(picture, kind, desc):
+    """Returns a Picture as Ogg METADATA_BLOCK_PICTURE or MP4Cover, encoded once for all files."""
+    key = (kind, desc)
+    value = picture.encoded.get(key)
+    if value is None:
+        if kind == "ogg":
+            value = base64.b64encode(flac_block(picture, desc).write()).decode("ascii")
+        else:
+            formats = dict((mime, format) for (format, mime) in mp4_cover_mimes.items())
+            value = mp4.MP4Cover(picture.data, formats[picture.mime])
+        picture.encoded[key] = value
+    return value
+
+
+def picture_data(path, position):
+    """Reads the data of the picture at a position of embedded_pictures from a file."""
+    complex = load_file(path)
+    pictures = embedded_pictures(complex) if complex is not None else []
+    if position >= len(pictures):
+        raise IOError("Picture %d is no longer embedded in %s" % (position, path))
+    return pictures[position][0]
+
+
+class PictureLoader(collections.namedtuple("PictureLoader", "path position")):
+    """Reads a picture from a file again, loaders of the same file and position compare equal."""
+    __slots__ = ()
+
+    def __call__(self):
+        return picture_data(self.path, self.position)
+
+
+def embed_picture(complex, picture, desc):
+    """Embeds a Picture as front cover with the given description, returns False if impossible."""
+    if isinstance(complex, mp3.MP3):
+        if complex.tags is None:
+            complex.add_tags()
+        complex.tags.add(id3.APIC(3, picture.mime, 3, desc, picture.data))
+    elif isinstance(complex, flac.FLAC):
+        blocks = [block for block in complex.pictures if (block.type, block.desc) != (3, desc)]
+        complex.clear_pictures()
+        for block in blocks + [flac_block(picture, desc)]:
+            complex.add_picture(block)
+    elif isinstance(complex, ogg.OggFileType):
+        values = []
+        for value in complex.tags.get("metadata_block_picture", []):
+            try:
+                block = flac.Picture(base64.b64decode(value))
+            except (TypeError, ValueError, flac.error):
+                continue
+            if (block.type, block.desc) != (3, desc):
+                values.append(value)
+        values.append(encoded_picture(picture, "ogg", desc))
+        complex.tags["metadata_block_picture"] = values
+    elif isinstance(complex, mp4.MP4):
+        if picture.mime not in mp4_cover_mimes.values():
+            # MP4 covers can only be JPEG or PNG.
+            return False
+        if complex.tags is None:
+            complex.add_tags()
+        covers = list(complex.tags.get("covr", []))
+        # MP4 covers carry no description.
+        complex.tags["covr"] = [encoded_picture(picture, "mp4", "")] + covers[1:]
+    else:
+        return False
+    return True
+
+
+def save_atomic(media, padding=None):
+    """Saves a file through a temporary sibling, returns a SaveResult.
+
+    The original is only replaced once the copy is complete, so a crash
+    never leaves a half-written file behind. Such a save is never in
+    place, the copied bytes are counted as moved.
+    """
+    import shutil
+    import tempfile
+    directory, name = os.path.split(media.path)
+    handle, tmp = tempfile.mkstemp(prefix="."+name+".", suffix=".tmp", dir=directory or ".")
+    os.close(handle)
+    try:
+        shutil.copyfile(media.path, tmp)
+        shutil.copymode(media.path, tmp)
+        copied = os.path.getsize(tmp)
+        result = save_media(media, padding, tmp)
+        # os.rename cannot replace existing files on Windows.
+        getattr(os, "replace", os.rename)(tmp, media.path)
+    except Exception:
+        os.remove(tmp)
+        raise
+    result.in_place = False
+    result.bytes_moved += copied
+    result.bytes_written += copied
+    return result
+
+
+def timed(function, *args):
+    """Calls a function and returns (result, seconds taken)."""
+    started = time.time()
+    result = function(*args)
+    return result, time.time() - started
+
+
+class SaveReport(object):
+    """Outcome of a batched save."""
+
+    def __init__(self):
+        # Maps file ids to None on success or the error that occurred.
+        self.results = {}
+        # Maps file ids to the SaveResult of every saved file.
+        self.saves = {}
+        self.bytes_written = 0
+        self.bytes_moved = 0
+        self.elapsed = 0.0
+
+    def get_failed(self):
+        """Returns the ids of files that could not be saved."""
+        return [file_id for file_id in self.results if self.results[file_id] is not None]
+
+    def files_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return len(self.results) / self.elapsed
+
+    def __repr__(self):
+        return "<SaveReport %d files, %d failed, %d bytes, %d moved, %.1f files/s>" % (
+            len(self.results), len(self.get_failed()), self.bytes_written, self.bytes_moved,
+            self.files_per_second())
+
+
+class RescanReport(object):
+    """Differences found by a rescan."""
+
+    def __init__(self):
+        # Ids of new files, of files changed on disk and paths of dropped files.
+        self.added = []
+        self.modified = []
+        self.removed = []
+        # Ids of files changed or removed on disk while they had unsaved edits.
+        self.conflicts = []
+        self.errors = []
+
+    def is_empty(self):
+        return not (self.added or self.modified or self.removed or self.conflicts or self.errors)
+
+    def __repr__(self):
+        return "<RescanReport %d added, %d modified, %d removed, %d conflicts, %d errors>" % (
+            len(self.added), len(self.modified), len(self.removed), len(self.conflicts), len(self.errors))
+
 
 class Tagger(object):
     """The Tagger is the model carrying out the actual tagging."""
     
     class MediaFile(object):
-        """This class holds tag information used here."""
+        """This class holds tag information used here.
+
+        Only path, type and a plain dictionary of the easy tag values are
+        kept. The complex mutagen object, including all embedded pictures,
+        is loaded on demand and released again once the file was saved.
+        """
+        __slots__ = ["simple", "complex", "path", "type", "dirty", "pictures", "stat"]
         
-        def __init__(self, simple, complex, path):
+        def __init__(self, simple, complex, path, type):
             self.simple = simple
             self.complex = complex
             self.path = path
-            self.type = self.complex.__class__.__name__.lower()
+            self.type = type
+            # Keys written since the last save, "image" stands for embedded pictures.
+            self.dirty = set()
+            # (Picture, description) of every picture embedded since the last save.
+            self.pictures = []
+            # The (size, mtime) of the file on disk matching the tags, see rescan.
+            self.stat = None
+
+        def load(self):
+            """Parses the file into its complex mutagen object if necessary."""
+            if self.complex is None:
+                self.complex = mutagen.File(self.path)
+            return self.complex
+
+        def apply(self):
+            """Carries pending textual changes over to the complex object, which is returned."""
+            complex = self.load()
+            easy = easy_view(complex)
+            for key in self.dirty:
+                if key == "image":
+                    continue
+                if key in self.simple:
+                    easy[key] = self.simple[key]
+                elif key in easy:
+                    del easy[key]
+            return complex
+
+        def release(self):
+            """Marks the file as saved and drops the complex object."""
+            self.dirty.clear()
+            self.pictures = []
+            self.complex = None
+            self.stat = file_signature(self.path)
         
 
-    def __init__(self):
-        self.files = {}
+    def __init__(self, workers=1, pool="thread", index=None, extensions=audio_extensions, sniff=False,
+                 debounce=0.0, indexed_keys=("artist", "album", "albumartist", "genre"), stats=None,
+                 tags_only=False, padding=None):
+        """workers > 1 loads files in parallel on a "thread" or "process" pool.
+
+        An optional TagIndex lets unchanged files be opened from the cache.
+        add_dir only parses files with one of the given extensions (None
+        allows all) and, if sniff is set, a recognized audio header.
+        Changes are reported to subscribers in batches collected over
+        debounce seconds. Files can be looked up by the values of the
+        indexed_keys without scanning all of them. A Stats object, if
+        given, records the timing and I/O of scans, parses, image reads
+        and saves. With tags_only files are loaded without analysing their
+        audio streams, stream info is only parsed by get_info. Tags are
+        saved with the given Padding policy, a default one if None.
+        """
+        self.indexed_keys = indexed_keys
+        self.files = FileCollection(indexed_keys)
+        self.errors = []
+        self.skipped = 0
+        self.workers = workers
+        self.pool = pool
+        self.index = index
+        self.extensions = extensions
+        self.sniff = sniff
+        self.artwork = ArtworkCache()
+        self.changes = ChangeNotifier(debounce)
+        self.stats = stats
+        self.tags_only = tags_only
+        self.padding = padding if padding is not None else Padding()
+        # The directory last loaded by add_dir, checked again by rescan.
+        self.root = None
+        # Audio hashes, created by the first find_duplicates.
+        self.hashes = None
 
     def add_file(self, path, file_id=0):
         """Add a single File to the Tagger."""
         if file_id == 0:
-            self.files = {}
-        if os.path.exists(path):
-            tagger = mutagen.File(path, easy=True)
-            if tagger != None:
-                self.files[file_id] = self.MediaFile(tagger, mutagen.File(path), path)
+            self.files = FileCollection(self.indexed_keys)
+        media = self.cached_file(path)
+        if media is None:
+            stat = file_signature(path)
+            media = self.parsed_file(path, self.read_file(path), stat)
+        self.insert_file(file_id, media)
+        if self.index is not None:
+            self.index.commit()
+
+    def insert_file(self, file_id, media):
+        """Registers a loaded file under the given id."""
+        if media is not None:
+            self.files[file_id] = media
 
-    def add_dir(self, path):
+    def read_file(self, path):
+        """Parses a file with read_file, recording it if instrumentation is enabled."""
+        if self.stats is None:
+            return read_file(path, self.tags_only)
+        return self.measured(path, read_file_measured(path, self.tags_only))
+
+    def measured(self, path, result):
+        """Records the outcome of read_file_measured and returns the parse result."""
+        parsed, seconds, size = result
+        self.stats.record("parse", seconds, path, bytes_read=size)
+        return parsed
+
+    def cached_file(self, path):
+        """Returns a file whose tags are known from the index, without parsing it."""
+        if self.index is None:
+            return None
+        cached = self.index.lookup(path)
+        if cached is None:
+            return None
+        type, tags = cached
+        media = self.MediaFile(tags, None, path, type)
+        media.stat = file_signature(path)
+        return media
+
+    def parsed_file(self, path, parsed, stat):
+        """Wraps the (type, tags) of a freshly parsed file and remembers them in the index.
+
+        stat is the signature of the file taken before it was parsed, so a
+        change made while parsing is still noticed by the next rescan.
+        """
+        if parsed is None:
+            return None
+        type, tags = parsed
+        media = self.MediaFile(tags, None, path, type)
+        media.stat = stat
+        if self.index is not None:
+            self.index.store(path, media.type, media.simple)
+        return media
+
+    def add_dir(self, path, workers=None):
         """Add a whole directory to the Tagger."""
-        self.files = {}
-        files_to_add = []
-        directories = os.walk(path)
-        for dirpath, dirs, files in directories:
-            for single_file in files:
-                files_to_add.append(os.path.join(dirpath,single_file))    
-        self.add_files(sorted(files_to_add))
+        for file_id, media in self.iter_dir(path, workers):
+            pass
 
-    def add_files(self, paths):
-        """Add a bunch of directories to the Tagger."""
-        self.files = {}
+    def iter_dir(self, path, workers=None, resident=True):
+        """Loads a whole directory, yielding (file_id, MediaFile) as files are parsed."""
+        self.files = FileCollection(self.indexed_keys)
+        self.root = path
+        return self.iter_files(self.scan(path), workers, resident)
+
+    def scan(self, path):
+        """Returns the sorted paths of the files below a directory that will be parsed."""
+        started = time.time()
+        found = list(scan_dir(path))
+        files_to_add = self.filter_paths(found)
+        # Files rejected before parsing are reported separately from errors.
+        self.skipped = len(found) - len(files_to_add)
+        if self.stats is not None:
+            self.stats.record("scan", time.time() - started, path)
+        return sorted(files_to_add)
+
+    def filter_paths(self, paths):
+        """Returns the paths that may be audio files."""
+        accepted = []
         for path in paths:
-            self.add_file(path, len(self.files))
+            if self.extensions is not None and os.path.splitext(path)[1].lower() not in self.extensions:
+                continue
+            if self.sniff and not sniff_audio(path):
+                continue
+            accepted.append(path)
+        return accepted
+
+    def add_files(self, paths, workers=None):
+        """Add a bunch of directories to the Tagger."""
+        self.skipped = 0
+        self.root = None
+        for file_id, media in self.iter_files(paths, workers):
+            pass
+
+    def iter_files(self, paths, workers=None, resident=True):
+        """Loads files, yielding (file_id, MediaFile) as soon as each one is parsed.
+
+        With resident=False a file is dropped from the Tagger once the
+        consumer advances, so trees of any size are processed in bounded
+        memory. Changes have to be saved before moving on to the next file.
+        """
+        self.files = FileCollection(self.indexed_keys)
+        self.errors = []
+        file_id = 0
+        try:
+            for path, media in self.load_files(paths, workers):
+                self.insert_file(file_id, media)
+                yield file_id, media
+                if not resident:
+                    del self.files[file_id]
+                file_id += 1
+        finally:
+            if self.index is not None:
+                self.index.commit()
+
+    def load_files(self, paths, workers=None):
+        """Loads files and yields (path, MediaFile) pairs in the given order.
+
+        Files that cannot be parsed are recorded in self.errors as
+        (path, error) pairs instead of aborting the whole scan.
+        """
+        if workers is None:
+            workers = self.workers
+        executor = None
+        futures = load_futures() if workers > 1 else None
+        if futures is not None:
+            if self.pool == "process":
+                executor = futures.ProcessPoolExecutor(max_workers=workers)
+            else:
+                executor = futures.ThreadPoolExecutor(max_workers=workers)
+        # Only a few files per worker are parsed ahead of the consumer,
+        # so memory stays flat no matter how many paths are given.
+        ahead = workers * 4
+        reader = read_file if self.stats is None else read_file_measured
+        paths = iter(paths)
+        jobs = collections.deque()
+        try:
+            while True:
+                for path in itertools.islice(paths, max(ahead - len(jobs), 0)):
+                    # Only files missing from the index have to be parsed at all.
+                    media = self.cached_file(path)
+                    stat = None
+                    if media is None:
+                        stat = file_signature(path)
+                        if executor is not None:
+                            media = executor.submit(reader, path, self.tags_only)
+                    jobs.append((path, media, stat))
+                if not jobs:
+                    break
+                path, job, stat = jobs.popleft()
+                if isinstance(job, self.MediaFile):
+                    yield path, job
+                    continue
+                try:
+                    if job is None:
+                        parsed = reader(path, self.tags_only)
+                    else:
+                        parsed = job.result()
+                    if self.stats is not None:
+                        parsed = self.measured(path, parsed)
+                    media = self.parsed_file(path, parsed, stat)
+                except Exception as error:
+                    self.errors.append((path, error))
+                    continue
+                if media is not None:
+                    yield path, media
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def rescan(self, path=None, workers=None):
+        """Picks up changes made to the loaded files by other programs.
+
+        Files are compared by size and modification time, only added and
+        modified ones are parsed again and removed ones are dropped. The
+        directory defaults to the one loaded by add_dir, without one only
+        the loaded files are checked. Unsaved edits win over the values on
+        disk, files changed or removed while they had such edits are kept
+        and reported as conflicts. Returns a RescanReport.
+        """
+        report = RescanReport()
+        if path is None:
+            path = self.root
+        loaded = dict((media.path, file_id) for (file_id, media) in self.files.items())
+        found = set(self.scan(path)) if path is not None else None
+        changed = []
+        for file_id, media in self.files.items():
+            stat = None
+            if found is None or media.path in found:
+                stat = file_signature(media.path)
+            if stat is None:
+                if media.dirty:
+                    # Removed files with edits are reported once, until they show up again.
+                    if media.stat is not None:
+                        report.conflicts.append(file_id)
+                        media.stat = None
+                else:
+                    del self.files[file_id]
+                    report.removed.append(media.path)
+                    self.changes.notify(file_id)
+            elif stat != media.stat:
+                changed.append(media.path)
+        added = sorted(found.difference(loaded)) if found is not None else []
+        errors = len(self.errors)
+        for media_path, media in self.load_files(changed + added, workers):
+            file_id = loaded.get(media_path)
+            if file_id is None:
+                # Ids are never reused, views may still refer to those of removed files.
+                file_id = self.files.next_id
+                report.added.append(file_id)
+            else:
+                old = self.files[file_id]
+                if old.dirty:
+                    self.merge_edits(old, media)
+                    report.conflicts.append(file_id)
+                report.modified.append(file_id)
+            self.insert_file(file_id, media)
+            self.changes.notify(file_id)
+        report.errors = self.errors[errors:]
+        if self.index is not None:
+            self.index.commit()
+        return report
+
+    def merge_edits(self, old, media):
+        """Carries the unsaved edits of a file over to its freshly loaded version."""
+        for key in old.dirty:
+            if key in old.simple:
+                media.simple[key] = old.simple[key]
+            else:
+                media.simple.pop(key, None)
+        media.dirty = old.dirty
+        # The old complex object holds the tags found on disk before, pictures
+        # are embedded into the new version instead so changes on disk are kept.
+        for picture, desc in old.pictures:
+            embed_picture(media.load(), picture, desc)
+        media.pictures = old.pictures
+
+    def find_duplicates(self, workers=4):
+        """Returns groups of ids of files with the same audio, however they are tagged.
+
+        Only the audio payload is hashed, see the duplicates module. Hashes
+        are computed on a pool of workers and cached by path, size and
+        mtime. Files that cannot be read are recorded in self.errors.
+        """
+        from PYD3Tagger.duplicates import HashCache, hash_audio
+        if self.hashes is None:
+            self.hashes = HashCache(self.index)
+        hashed = []
+        missing = []
+        for file_id in self.files:
+            path = self.get_path(file_id)
+            signature = file_signature(path)
+            if signature is None:
+                continue
+            digest = self.hashes.get(path, signature)
+            if digest is None:
+                missing.append((file_id, path, signature))
+            else:
+                hashed.append((file_id, digest))
+        # With instrumentation every file is timed where it is hashed.
+        hash_file = hash_audio if self.stats is None else functools.partial(timed, hash_audio)
+        futures = load_futures() if workers > 1 else None
+        if futures is not None:
+            executor = futures.ThreadPoolExecutor(max_workers=workers)
+            jobs = [executor.submit(hash_file, path) for (file_id, path, signature) in missing]
+        else:
+            executor = None
+            jobs = [None] * len(missing)
+        try:
+            for (file_id, path, signature), job in zip(missing, jobs):
+                try:
+                    digest = hash_file(path) if job is None else job.result()
+                except (IOError, OSError, ValueError) as error:
+                    self.errors.append((path, error))
+                    continue
+                if self.stats is not None:
+                    digest, seconds = digest
+                    self.stats.record("hash", seconds, path)
+                self.hashes.put(path, signature, digest)
+                hashed.append((file_id, digest))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        if self.index is not None:
+            self.index.commit()
+        groups = {}
+        for file_id, digest in hashed:
+            groups.setdefault(digest, []).append(file_id)
+        duplicates = [self.files.in_order(ids) for ids in groups.values() if len(ids) > 1]
+        return sorted(duplicates, key=lambda ids: self.get_position(ids[0]))
 
     def get_ids(self):
         """Returns a list of ids identifying individual files."""
         return self.files.keys()
 
+    def get_id(self, position):
+        """Returns the id of the file at a position in the file list."""
+        return self.files.get_id(position)
+
+    def get_position(self, file_id):
+        """Returns the position of a file in the file list."""
+        return self.files.get_position(file_id)
+
+    def find(self, **criteria):
+        """Returns the ids of the files with the given tag values, e.g. find(album="Woods III")."""
+        return self.files.find(**criteria)
+
+    def group_by(self, key):
+        """Returns a dictionary of every value of a tag to the ids of the files carrying it."""
+        return self.files.group_by(key)
+
     def get_type(self, file_id):
         """Returns the type of the given file."""
         return self.files[file_id].type
@@ -57,58 +951,216 @@ class Tagger(object):
         """Returns the path of the given file."""
         return self.files[file_id].path
 
+    def get_info(self, file_id):
+        """Returns the mutagen stream info (length, bitrate, ...) of a file, parsing it if necessary."""
+        return self.files[file_id].load().info
+
     def swap(self, id1, id2):
-        """Swaps two files around in the file list."""
-        tmp = self.files[id1]
-        self.files[id1] = self.files[id2]
-        self.files[id2] = tmp
+        """Swaps two files around in the file list, their ids stay the same."""
+        self.files.swap(id1, id2)
+        self.changes.notify(id1)
+        self.changes.notify(id2)
+
+    def subscribe(self, callback):
+        """Registers a callback receiving {file_id: set of changed keys} batches.
+
+        A key of None means the whole file changed, e.g. by reordering.
+        With a debounce window, callbacks are run on a timer thread.
+        """
+        self.changes.subscribe(callback)
+
+    def unsubscribe(self, callback):
+        self.changes.unsubscribe(callback)
         
     def write_single(self, file_id, key, value="", **kwargs):
-        """Write a single tag value for a single file."""
+        """Write a single tag value for a single file.
+
+        Keys and values the file's tags cannot hold raise a KeyError or
+        ValueError right away, not only once the file is saved.
+        """
         if key == "image":
-            if self.files[file_id].type == "mp3":
-                path = kwargs.get("path")
-                image_type = imghdr.what(path)
-                if image_type in ["gif", "jpeg", "png"]:
-                    if self.get_type(file_id) == "mp3": 
-                        file = self.files[file_id].complex
-                        image = open(path, 'rb').read()
-                        file.tags.add(id3.APIC(3, 'image/'+image_type, 3, kwargs.get("name"), image)) 
-                else:
-                    # We fail silently if an invalid image format is given.
-                    pass
-            else:
-                #TODO: Handle more file types.
-                pass
+            self.write_image([file_id], kwargs.get("path"), kwargs.get("name"))
         else:
             # All other tag types are handled generically
-            self.files[file_id].simple[key] = value
+            media = self.files[file_id]
+            if isinstance(value, list):
+                new = value
+            else:
+                new = [value]
+            # Rewriting an unchanged value must not make the file dirty.
+            if key in media.simple and list(media.simple[key]) == new:
+                return
+            check_tag(media.type, key, new)
+            # The change is kept in the tag dictionary until the file is saved.
+            self.files.set_tag(file_id, key, new)
+            media.dirty.add(key)
+            self.changes.notify(file_id, key)
+
+    def clear_single(self, file_id, key):
+        """Remove a single tag from a single file."""
+        media = self.files[file_id]
+        if key in media.simple:
+            self.files.set_tag(file_id, key, None)
+            media.dirty.add(key)
+            self.changes.notify(file_id, key)
+
+    def read_image_file(self, path):
+        """Reads and validates an image file, returns a Picture or None."""
+        image = open(path, 'rb').read()
+        import imghdr
+        image_type = imghdr.what(None, image)
+        if image_type not in ["gif", "jpeg", "png"]:
+            return None
+        return self.artwork.get(image, 'image/'+image_type)
+
+    def supports_pictures(self, file_id):
+        """Tells whether pictures can be read from and embedded into a file."""
+        return self.files[file_id].type in picture_types
+
+    def write_image(self, file_ids, image, name=None):
+        """Embeds one image as front cover into several files.
+
+        The image is either a path or a Picture, e.g. one read from another
+        file. It is read and validated once, all files reference the same
+        data until they are saved. A previous cover with the same name is
+        replaced, MP4 files only replace their first cover.
+        """
+        if not isinstance(image, Picture):
+            image = self.read_image_file(image)
+        if image is None:
+            # We fail silently if an invalid image format is given.
+            return
+        for file_id in file_ids:
+            if not self.supports_pictures(file_id):
+                continue
+            media = self.files[file_id]
+            if embed_picture(media.load(), image, name or ""):
+                media.dirty.add("image")
+                media.pictures.append((image, name or ""))
+                self.changes.notify(file_id, "image")
 
     def write_all(self, key, value):
         """Write a single value to multiple files."""
         for file_id in self.files.keys():
             self.write_single(file_id, key, value)
 
+    def get_dirty(self):
+        """Returns the ids of files with unsaved changes."""
+        return [file_id for file_id in self.files if self.files[file_id].dirty]
+
     def save_all(self):
-        """Write changes in all files to disk."""
-        # TODO: Only save changed files (Keep track of writes)
-        for file_id in self.files.keys():
-            self.save_single(file_id)
+        """Write changes in all files to disk.
+
+        A file that cannot be saved does not stop the others, it stays
+        dirty. Returns a SaveReport with the result for every file.
+        """
+        report = SaveReport()
+        started = time.time()
+        for file_id in self.get_dirty():
+            try:
+                result = self.save_single(file_id)
+            except Exception as error:
+                report.results[file_id] = error
+            else:
+                report.results[file_id] = None
+                report.saves[file_id] = result
+                report.bytes_written += result.bytes_written
+                report.bytes_moved += result.bytes_moved
+        report.elapsed = time.time() - started
+        return report
         
     def save_single(self, file_id):
-        """Write changes to a single file to disk."""
-        if self.files[file_id].complex:
-            self.files[file_id].complex.save()
-        file = self.files[file_id].simple
-        # We are working with two separate tagging-objects.
-        # A simple one for textual and a complex one for media fields.
-        # The complex variant is saved first, the simple variant is then
-        # reinstantiated from the changed file and changes are applied.
-        changeable_file = mutagen.File(self.files[file_id].path, easy=True)
-        for key in self.files[file_id].simple:
-           changeable_file[key] = file[key] 
-        changeable_file.save()
-        self.files[file_id].simple = changeable_file
+        """Write changes to a single file to disk.
+
+        Returns a SaveResult telling whether the file was written in place,
+        or None if the file had no changes.
+        """
+        media = self.files[file_id]
+        if not media.dirty:
+            # Untouched files are skipped.
+            return None
+        # Textual changes are applied to the complex tagging-object, so
+        # textual and media fields are written in a single pass.
+        if self.stats is None:
+            result = save_media(media, self.padding)
+        else:
+            started = time.time()
+            result = save_media(media, self.padding)
+            self.stats.record("save", time.time() - started, media.path, bytes_written=result.bytes_written)
+        media.release()
+        if self.index is not None:
+            self.index.store(media.path, media.type, media.simple)
+            self.index.commit()
+        return result
+
+    def save_batch(self, workers=4, progress=None, atomic=True):
+        """Writes all changed files on a pool of I/O threads.
+
+        With atomic every file is written to a copy replacing it, see
+        save_atomic. Otherwise tags are written into the files themselves,
+        in place wherever the padding allows, like save_single does.
+        progress is called with (done, total, path) after every file, if it
+        returns False the files not yet written are left unsaved.
+        Returns a SaveReport with the result for every file and the
+        aggregate throughput.
+        """
+        report = SaveReport()
+        started = time.time()
+        dirty = self.get_dirty()
+        save = save_atomic if atomic else save_media
+        # With instrumentation every save is timed where it runs, not while waiting for it.
+        if self.stats is not None:
+            save = functools.partial(timed, save)
+        futures = load_futures() if workers > 1 else None
+        if futures is not None:
+            executor = futures.ThreadPoolExecutor(max_workers=workers)
+            jobs = [(file_id, executor.submit(save, self.files[file_id], self.padding)) for file_id in dirty]
+        else:
+            executor = None
+            jobs = [(file_id, None) for file_id in dirty]
+        cancelled = False
+        try:
+            for done, (file_id, job) in enumerate(jobs):
+                media = self.files[file_id]
+                if cancelled and (job is None or job.cancel()):
+                    continue
+                try:
+                    if job is None:
+                        result = save(media, self.padding)
+                    else:
+                        result = job.result()
+                except Exception as error:
+                    report.results[file_id] = error
+                else:
+                    if self.stats is not None:
+                        result, seconds = result
+                        self.stats.record("save", seconds, media.path, bytes_written=result.bytes_written)
+                    report.results[file_id] = None
+                    report.saves[file_id] = result
+                    report.bytes_written += result.bytes_written
+                    report.bytes_moved += result.bytes_moved
+                    media.release()
+                    if self.index is not None:
+                        self.index.store(media.path, media.type, media.simple)
+                if progress is not None and not cancelled:
+                    cancelled = progress(done+1, len(jobs), media.path) is False
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        if self.index is not None:
+            self.index.commit()
+        report.elapsed = time.time() - started
+        return report
+
+    def export_snapshot(self, path, keys=None):
+        """Writes the tags of all files to a JSON lines or CSV snapshot, see the snapshot module."""
+        from PYD3Tagger import snapshot
+        return snapshot.export(self, path, keys)
+
+    def import_snapshot(self, path, save=True):
+        """Applies an edited snapshot, only files with differing values are changed and saved."""
+        from PYD3Tagger import snapshot
+        return snapshot.apply(self, path, save)
 
     def read_all(self, file_id):
         """Returns the whole metadata dictionary associated with this file."""
@@ -116,24 +1168,9 @@ class Tagger(object):
 
     def read_single(self, file_id, key):
         """Retrieve data for a specific file and tag type."""
-        images = {}
         # Images are handled differently
         if key == "image":
-            # Only MP3 is currently supported
-            if self.files[file_id].type == "mp3":
-                tags = self.files[file_id].complex
-                for tag in tags:
-                    if tag.startswith("APIC:"):
-                        # The embedded images are extracted to tempfiles
-                        tmp = tempfile.NamedTemporaryFile()          
-                        tmp.write(tags[tag].data)
-                        tmp.flush()
-                        images[tag[5:]] = tmp
-                return images
-            else:
-                # Currently Image options will be invisible or fal silently
-                # TODO: Other file types.
-                pass
+            return self.read_pictures(file_id)
         elif key == "path":
             return [self.get_path(file_id)]
         elif key == "type":
@@ -142,6 +1179,41 @@ class Tagger(object):
             return [""]
         return self.files[file_id].simple[key]
 
+    def read_pictures(self, file_id):
+        """Returns a dictionary of descriptions to the Pictures embedded in a file.
+
+        Files not loaded anyway are parsed only for this, their complex
+        object is not kept. Embedded images are shared in memory, identical
+        covers across an album are only held once, and may be dropped
+        from the artwork cache to be read from the file again on access.
+        A tempfile is only written when a consumer asks for a Picture's name.
+        """
+        images = {}
+        media = self.files[file_id]
+        if media.type not in picture_types:
+            return images
+        started = time.time()
+        complex = media.complex
+        if complex is None:
+            complex = load_file(media.path)
+            if complex is None:
+                return images
+        for position, (data, info) in enumerate(embedded_pictures(complex)):
+            loader = None
+            if media.complex is None:
+                loader = PictureLoader(media.path, position)
+            key = info["desc"]
+            number = 1
+            while key in images:
+                # Only ID3 requires distinct descriptions.
+                number += 1
+                key = u"%s (%d)" % (info["desc"], number)
+            images[key] = self.artwork.get(data, loader=loader, **info)
+        if self.stats is not None:
+            self.stats.record("image", time.time() - started, media.path,
+                              bytes_read=sum(len(picture) for picture in images.values()))
+        return images
+
     def print_debug(self):
         """Prints the available data for debugging or informational purposes."""
         for file_id in self.files:
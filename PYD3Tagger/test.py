@@ -1,6 +1,16 @@
 # -*- coding: utf-8
-from PYD3Tagger.tagger import Tagger
+from PYD3Tagger.cli import BatchJob, Rule
+from PYD3Tagger.duplicates import hash_audio
+from PYD3Tagger.index import TagIndex
+from PYD3Tagger.stats import Stats
+from PYD3Tagger.tagger import Padding, Tagger
+import hashlib
+import json
+import os
 import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 
 class TaggingTests(unittest.TestCase):
@@ -42,10 +52,113 @@ class TaggingTests(unittest.TestCase):
         self.tagger.add_file(self.testfile)
         self.assertEqual(self.tagger.read_single(0, "artist"), [u"Woods of Ypres"])
 
+    def test_save_only_dirty(self):
+        self.tagger.add_dir(self.testdir)
+        self.tagger.write_all("artist", "Woods of Ypres")
+        self.assertEqual(self.tagger.get_dirty(), [])
+        self.tagger.write_single(1, "artist", "Ypres of Woods")
+        self.assertEqual(self.tagger.get_dirty(), [1])
+        mtime = os.stat(self.tagger.get_path(0)).st_mtime
+        self.tagger.save_all()
+        self.assertEqual(self.tagger.get_dirty(), [])
+        self.assertEqual(mtime, os.stat(self.tagger.get_path(0)).st_mtime)
+        self.tagger.add_dir(self.testdir)
+        self.assertEqual(self.tagger.read_single(1, "artist"), [u"Ypres of Woods"])
+        self.tagger.write_single(1, "artist", "Woods of Ypres")
+        self.tagger.save_all()
+
+    def test_save_batch(self):
+        self.tagger.add_dir(self.testdir)
+        self.tagger.write_all("album", "Woods III")
+        report = self.tagger.save_batch()
+        self.assertEqual(len(report.results), len(self.tagger.files))
+        self.assertEqual(report.get_failed(), [])
+        self.assertTrue(report.bytes_written > 0)
+        self.assertEqual(self.tagger.get_dirty(), [])
+        self.tagger.add_dir(self.testdir)
+        self.assertEqual(len(self.tagger.files), 15)
+        self.assertEqual(self.tagger.read_single(0, "album"), [u"Woods III"])
+        # Without atomic replacement small edits fit into the padding left by the first save.
+        self.tagger.write_all("album", "Woods IV")
+        report = self.tagger.save_batch(atomic=False)
+        self.assertEqual(report.get_failed(), [])
+        self.assertEqual(report.bytes_moved, 0)
+        self.assertTrue(all(result.in_place for result in report.saves.values()))
+
+    def test_change_notification(self):
+        batches = []
+        self.tagger.subscribe(batches.append)
+        self.tagger.add_dir(self.testdir)
+        self.tagger.write_single(0, "artist", "Woods of Ypres")
+        self.assertEqual(batches, [])
+        self.tagger.write_single(0, "artist", "Ypres of Woods")
+        self.tagger.swap(1, 2)
+        self.assertEqual(batches, [{0: set(["artist"])}, {1: set([None])}, {2: set([None])}])
+        self.tagger.unsubscribe(batches.append)
+
+    def test_change_notification_debounced(self):
+        batches = []
+        debounced = Tagger(debounce=60)
+        debounced.subscribe(batches.append)
+        debounced.add_dir(self.testdir)
+        for file_id in debounced.get_ids():
+            debounced.write_single(file_id, "album", "Woods III")
+            debounced.write_single(file_id, "genre", "Doom")
+        self.assertEqual(batches, [])
+        debounced.changes.flush()
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(batches[0][0], set(["album", "genre"]))
+        self.assertEqual(len(batches[0]), 15)
+
     def test_open_dir(self):
         self.tagger.add_dir(self.testdir) 
         self.assertEqual(len(self.tagger.files), 15)
 
+    def test_open_dir_parallel(self):
+        self.tagger.add_dir(self.testdir)
+        parallel = Tagger(workers=4)
+        parallel.add_dir(self.testdir)
+        self.assertEqual(len(parallel.files), 15)
+        self.assertEqual(parallel.errors, [])
+        for i in range(0, len(parallel.files)):
+            self.assertEqual(parallel.get_path(i), self.tagger.get_path(i))
+
+    def test_open_dir_indexed(self):
+        handle, indexpath = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        indexed = Tagger(index=TagIndex(indexpath))
+        indexed.add_dir(self.testdir)
+        indexed.add_dir(self.testdir)
+        self.assertEqual(len(indexed.files), 15)
+        for i in range(0, len(indexed.files)):
+            # The second scan is served from the index without parsing.
+            self.assertIsNone(indexed.files[i].complex)
+            self.assertEqual(indexed.read_single(i, "artist"), [u"Woods of Ypres"])
+        indexed.index.close()
+        os.remove(indexpath)
+
+    def test_iter_dir(self):
+        seen = []
+        for file_id, media in self.tagger.iter_dir(self.testdir, resident=False):
+            self.assertEqual(list(self.tagger.get_ids()), [file_id])
+            self.assertEqual(self.tagger.read_single(file_id, "artist"), [u"Woods of Ypres"])
+            seen.append(media.path)
+        self.assertEqual(len(seen), 15)
+        self.assertEqual(seen, sorted(seen))
+        self.assertEqual(len(self.tagger.files), 0)
+
+    def test_filter_paths(self):
+        paths = ["a.mp3", "cover.jpg", "b.FLAC", "rip.log", "c.ogg"]
+        self.assertEqual(self.tagger.filter_paths(paths), ["a.mp3", "b.FLAC", "c.ogg"])
+        # Every format mutagen parses is allowed by default.
+        paths = ["a.tak", "b.ac3", "c.eac3", "d.dff", "e.mid", "f.aifc", "g.m4p", "h.m4r", "i.3gp"]
+        self.assertEqual(self.tagger.filter_paths(paths), paths)
+        self.tagger.add_dir(self.testdir)
+        self.assertEqual(len(self.tagger.files), 15)
+        sniffing = Tagger(sniff=True)
+        sniffing.add_dir(self.testdir)
+        self.assertEqual(len(sniffing.files), 15)
+
     def test_read_all(self):
         self.tagger.add_dir(self.testdir)
         for i in range(0, len(self.tagger.files)): 
@@ -68,6 +181,84 @@ class TaggingTests(unittest.TestCase):
         images = self.tagger.read_single(0, "image")
         self.assertIsNotNone(images["test"])
 
+    def test_read_image_shared(self):
+        self.tagger.add_dir(self.testdir)
+        for file_id in [0, 1]:
+            self.tagger.write_single(file_id, "image", path="woods.jpg", name="test")
+        image0 = self.tagger.read_single(0, "image")["test"]
+        image1 = self.tagger.read_single(1, "image")["test"]
+        # Identical covers are held once and only written out on demand.
+        self.assertIs(image0, image1)
+        self.assertIsNone(image0.tmp)
+        self.assertEqual(open(image0.name, 'rb').read(), open("woods.jpg", 'rb').read())
+
+    def test_read_image_lazy(self):
+        self.tagger.add_file(self.testfile)
+        self.tagger.write_single(0, "image", path="woods.jpg", name="test")
+        self.tagger.save_all()
+        picture = self.tagger.read_single(0, "image")["test"]
+        # Reading pictures does not keep the complex object of a saved file.
+        self.assertIsNone(self.tagger.files[0].complex)
+        info = picture.describe()
+        self.assertEqual((info["type"], info["desc"], info["mime"]), (3, "test", "image/jpeg"))
+        self.assertEqual(info["size"], os.path.getsize("woods.jpg"))
+        self.assertTrue(info["width"] > 0 and info["height"] > 0)
+        # Dropped data is read from the file again on access.
+        picture.unload()
+        self.assertFalse(picture.is_loaded())
+        self.assertEqual(picture.data, open("woods.jpg", 'rb').read())
+        # A picture shared by several files is read from any file still holding it.
+        directory = tempfile.mkdtemp()
+        tagger = Tagger()
+        for name in ["a.mp3", "b.mp3"]:
+            shutil.copy(self.testfile, os.path.join(directory, name))
+        tagger.add_dir(directory)
+        for file_id in tagger.get_ids():
+            tagger.write_single(file_id, "image", path="woods.jpg", name="test")
+        tagger.save_all()
+        shared = tagger.read_single(0, "image")["test"]
+        self.assertIs(tagger.read_single(1, "image")["test"], shared)
+        os.remove(tagger.get_path(0))
+        shared.unload()
+        self.assertEqual(shared.data, open("woods.jpg", 'rb').read())
+        os.remove(tagger.get_path(1))
+        shared.unload()
+        self.assertRaises(IOError, lambda: shared.data)
+        shutil.rmtree(directory)
+
+    def test_complex_loaded_on_demand(self):
+        self.tagger.add_dir(self.testdir)
+        self.tagger.write_single(0, "title", "The Northern Cold")
+        self.assertIsNone(self.tagger.files[0].complex)
+        self.tagger.write_single(1, "image", path="woods.jpg", name="test")
+        self.assertIsNotNone(self.tagger.files[1].complex)
+        self.tagger.save_all()
+        # Saved files drop their complex object again.
+        self.assertIsNone(self.tagger.files[1].complex)
+        self.assertIsNotNone(self.tagger.read_single(1, "image")["test"])
+
+    def test_write_image_shared(self):
+        self.tagger.add_dir(self.testdir)
+        self.tagger.write_image(self.tagger.get_ids(), "woods.jpg", "test")
+        frames = [self.tagger.files[i].complex.tags["APIC:test"] for i in self.tagger.get_ids()]
+        # All files reference a single copy of the image data.
+        for frame in frames:
+            self.assertIs(frame.data, frames[0].data)
+        self.assertEqual(len(self.tagger.get_dirty()), 15)
+
+    def test_batch_dry_run(self):
+        rules = [Rule("set", "artist", "Ypres of Woods"), Rule("copy", "albumartist", source="artist")]
+        summary = BatchJob(rules, dry_run=True).run(self.testdir)
+        self.assertEqual(summary["files_scanned"], 15)
+        self.assertEqual(summary["files_changed"], 15)
+        self.assertEqual(summary["bytes_written"], 0)
+        self.tagger.add_dir(self.testdir)
+        self.assertEqual(self.tagger.read_single(0, "artist"), [u"Woods of Ypres"])
+        # Copying a missing key and setting present values changes nothing.
+        rules = [Rule("copy", "albumartist", source="lyricist"), Rule("set", "artist", "Woods of Ypres")]
+        summary = BatchJob(rules, dry_run=True).run(self.testdir)
+        self.assertEqual(summary["files_changed"], 0)
+
     def test_get_type(self):
         self.tagger.add_file(self.testfile)
         type = self.tagger.get_type(0)
@@ -80,9 +271,250 @@ class TaggingTests(unittest.TestCase):
         self.tagger.add_dir(self.testdir)
         file0 = self.tagger.files[0]
         file1 = self.tagger.files[1]
+        ids = self.tagger.get_ids()
         self.tagger.swap(0, 1)
-        self.assertEqual(file0, self.tagger.files[1])
-        self.assertEqual(file1, self.tagger.files[0])
+        # Only the positions change, the ids still refer to the same files.
+        self.assertEqual(file0, self.tagger.files[0])
+        self.assertEqual(file1, self.tagger.files[1])
+        self.assertEqual(self.tagger.get_ids(), [1, 0] + ids[2:])
+        self.assertEqual(self.tagger.get_position(0), 1)
+        self.assertEqual(self.tagger.get_id(0), 1)
+
+    def test_find(self):
+        self.tagger.add_dir(self.testdir)
+        ids = self.tagger.get_ids()
+        self.assertEqual(self.tagger.find(artist=u"Woods of Ypres"), ids)
+        self.assertEqual(self.tagger.find(artist=u"Ypres of Woods"), [])
+        self.tagger.write_single(3, "artist", "Ypres of Woods")
+        self.assertEqual(self.tagger.find(artist=u"Ypres of Woods"), [3])
+        self.assertEqual(len(self.tagger.find(artist=u"Woods of Ypres")), 14)
+        groups = self.tagger.group_by("artist")
+        self.assertEqual(sorted(groups.keys()), [u"Woods of Ypres", u"Ypres of Woods"])
+        # Reordering keeps the indexed values with the ids of their files.
+        self.tagger.swap(3, 4)
+        self.assertEqual(self.tagger.find(artist=u"Ypres of Woods"), [3])
+
+    def test_stats(self):
+        stats = Stats(slowest=2)
+        recorded = []
+        stats.add_hook(lambda operation, *args: recorded.append(operation))
+        tagger = Tagger(stats=stats)
+        tagger.add_dir(self.testdir)
+        tagger.write_single(0, "album", "Instrumented")
+        result = tagger.save_single(0)
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot["scan"]["count"], 1)
+        self.assertEqual(snapshot["parse"]["count"], len(tagger.files))
+        self.assertTrue(snapshot["parse"]["bytes_read"] > 0)
+        self.assertEqual(len(snapshot["parse"]["slowest"]), 2)
+        self.assertEqual(sum(snapshot["parse"]["histogram"].values()), len(tagger.files))
+        # Only the bytes actually written are counted, not the whole file.
+        self.assertEqual(snapshot["save"]["bytes_written"], result.bytes_written)
+        self.assertTrue(result.bytes_written > 0)
+        if result.in_place:
+            self.assertTrue(result.bytes_written < result.size)
+        self.assertEqual(recorded.count("save"), 1)
+        self.assertEqual(Tagger().stats, None)
+
+    def test_tags_only(self):
+        self.tagger.add_dir(self.testdir)
+        fast = Tagger(tags_only=True)
+        fast.add_dir(self.testdir)
+        self.assertEqual(fast.get_ids(), self.tagger.get_ids())
+        for file_id in fast.get_ids():
+            self.assertEqual(fast.get_type(file_id), self.tagger.get_type(file_id))
+            self.assertEqual(fast.read_all(file_id), self.tagger.read_all(file_id))
+        # Stream info is parsed on request only.
+        self.assertEqual(fast.files[0].complex, None)
+        self.assertTrue(fast.get_info(0).length > 0)
+        # Text files named like MP3s are rejected as when parsing completely.
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, "readme.mp3"), "w") as handle:
+            handle.write("Not audio")
+        fast = Tagger(tags_only=True)
+        fast.add_dir(directory)
+        self.assertEqual(len(fast.files), 0)
+        self.assertEqual(len(fast.errors), 1)
+        shutil.rmtree(directory)
+
+    def test_padding(self):
+        tagger = Tagger(padding=Padding(headroom=16384, max_padding=65536))
+        tagger.add_file(self.testfile)
+        # A tag growing beyond its padding moves the audio once and reserves headroom.
+        tagger.write_single(0, "composer", "x" * 100000)
+        result = tagger.save_single(0)
+        self.assertFalse(result.in_place)
+        # Only the data behind the tag is moved, not the old tag itself.
+        self.assertTrue(0 < result.bytes_moved < result.size - 100000)
+        tagger.write_single(0, "composer", "y" * 100100)
+        result = tagger.save_single(0)
+        self.assertTrue(result.in_place)
+        self.assertEqual(result.bytes_moved, 0)
+        self.assertEqual(tagger.save_single(0), None)
+        # Shrinking the tag keeps it in place, even with padding beyond max_padding.
+        tagger.clear_single(0, "composer")
+        self.assertTrue(tagger.save_single(0).in_place)
+
+    def test_rescan(self):
+        self.tagger.add_dir(self.testdir)
+        self.assertTrue(self.tagger.rescan().is_empty())
+        self.tagger.write_single(0, "title", "Local")
+        self.tagger.write_single(1, "title", "Local")
+        # Another program changes two files behind the Tagger's back.
+        for file_id in [1, 2]:
+            other = Tagger()
+            other.add_file(self.tagger.get_path(file_id))
+            other.write_single(0, "title", "Disk")
+            other.write_single(0, "tracknumber", "99")
+            other.save_single(0)
+        report = self.tagger.rescan()
+        self.assertEqual(report.modified, [1, 2])
+        self.assertEqual(report.conflicts, [1])
+        self.assertEqual(report.added, [])
+        self.assertEqual(self.tagger.read_single(0, "title"), ["Local"])
+        self.assertEqual(self.tagger.read_single(1, "title"), ["Local"])
+        self.assertEqual(self.tagger.read_single(1, "tracknumber"), ["99"])
+        self.assertEqual(self.tagger.read_single(2, "title"), ["Disk"])
+        self.assertEqual(self.tagger.get_dirty(), [0, 1])
+
+    def test_rescan_conflicts(self):
+        directory = tempfile.mkdtemp()
+        for name in ["a.mp3", "b.mp3", "c.mp3"]:
+            shutil.copy(self.testfile, os.path.join(directory, name))
+        tagger = Tagger()
+        tagger.add_dir(directory)
+        # A pending picture is embedded into the version changed on disk, keeping its other changes.
+        tagger.write_single(0, "image", path="woods.jpg", name="test")
+        other = Tagger()
+        other.add_file(tagger.get_path(0))
+        other.write_single(0, "tracknumber", "99")
+        other.save_single(0)
+        self.assertEqual(tagger.rescan().conflicts, [0])
+        tagger.save_all()
+        tagger.add_file(tagger.get_path(0))
+        self.assertEqual(tagger.read_single(0, "tracknumber"), ["99"])
+        self.assertIn("test", tagger.read_single(0, "image"))
+        # A removed file with edits is reported once, not on every rescan.
+        tagger.add_dir(directory)
+        tagger.write_single(1, "title", "Local")
+        os.remove(tagger.get_path(1))
+        self.assertEqual(tagger.rescan().conflicts, [1])
+        self.assertTrue(tagger.rescan().is_empty())
+        # Ids of removed files are not given out again.
+        os.remove(tagger.get_path(2))
+        self.assertEqual(tagger.rescan().removed, [os.path.join(directory, "c.mp3")])
+        shutil.copy(self.testfile, os.path.join(directory, "d.mp3"))
+        self.assertEqual(tagger.rescan().added, [3])
+        shutil.rmtree(directory)
+
+    def test_snapshot(self):
+        self.tagger.add_dir(self.testdir)
+        for name in ["snapshot.jsonl", "snapshot.csv"]:
+            path = os.path.join(tempfile.mkdtemp(), name)
+            self.assertEqual(self.tagger.export_snapshot(path), len(self.tagger.files))
+            report = self.tagger.import_snapshot(path)
+            self.assertEqual(len(report.changes), 0)
+            self.assertEqual(report.unknown, [])
+        # Values with line breaks survive a CSV round trip unchanged.
+        tagger = Tagger()
+        tagger.add_file(self.testfile)
+        tagger.write_single(0, "title", [u"line one\nline two\r", u"Ünïcode, \"quoted\""])
+        path = os.path.join(tempfile.mkdtemp(), "multiline.csv")
+        tagger.export_snapshot(path)
+        self.assertEqual(len(tagger.import_snapshot(path, save=False).changes), 0)
+        # Only the file whose values differ from the loaded ones is written.
+        path = os.path.join(tempfile.mkdtemp(), "edited.jsonl")
+        with open(path, "w") as handle:
+            handle.write(json.dumps({"path": self.tagger.get_path(1), "title": "Corrected", "genre": None}) + "\n")
+            handle.write(json.dumps({"path": self.tagger.get_path(2), "title": self.tagger.read_single(2, "title")}) + "\n")
+            handle.write(json.dumps({"path": "missing.mp3", "title": "Nothing"}) + "\n")
+        report = self.tagger.import_snapshot(path)
+        self.assertEqual(list(report.changes.keys()), [1])
+        self.assertEqual(list(report.saves.keys()), [1])
+        self.assertEqual(report.unknown, ["missing.mp3"])
+        self.assertEqual(self.tagger.read_single(1, "title"), ["Corrected"])
+        self.assertEqual(self.tagger.read_single(1, "genre"), [""])
+        # A file with an invalid key is left alone, the files after it are still imported.
+        path = os.path.join(tempfile.mkdtemp(), "invalid.jsonl")
+        with open(path, "w") as handle:
+            handle.write(json.dumps({"path": self.tagger.get_path(3), "title": "Partial", "comment": "No ID3 key"}) + "\n")
+            handle.write(json.dumps({"path": self.tagger.get_path(4), "title": "Imported"}) + "\n")
+        report = self.tagger.import_snapshot(path)
+        self.assertEqual(list(report.errors.keys()), [3])
+        self.assertEqual(list(report.saves.keys()), [4])
+        self.assertNotEqual(self.tagger.read_single(3, "title"), ["Partial"])
+        self.assertEqual(self.tagger.get_dirty(), [])
+
+    def test_find_duplicates(self):
+        directory = tempfile.mkdtemp()
+        shutil.copy(self.testfile, os.path.join(directory, "original.mp3"))
+        shutil.copy(self.testfile, os.path.join(directory, "copy.mp3"))
+        other = [name for name in sorted(os.listdir(self.testdir)) if self.testdir + name != self.testfile][0]
+        shutil.copy(self.testdir + other, os.path.join(directory, "other.mp3"))
+        tagger = Tagger()
+        tagger.add_dir(directory)
+        # Retagging the copy must not hide it.
+        tagger.write_single(0, "title", "Retagged " * 1000)
+        tagger.save_all()
+        self.assertEqual(tagger.find_duplicates(), [[0, 1]])
+        self.assertEqual(tagger.find_duplicates(workers=1), [[0, 1]])
+        # A truncated MP4 ending within an atom header is hashed as a whole.
+        path = os.path.join(directory, "truncated.m4a")
+        truncated = b"\x00\x00\x00\x10ftypM4A \x00\x00\x00\x00" + b"\x00\x00\x00\x01mdat\x00\x00"
+        with open(path, "wb") as handle:
+            handle.write(truncated)
+        self.assertEqual(hash_audio(path), hashlib.sha1(truncated).hexdigest())
+        shutil.rmtree(directory)
+
+    def test_invalid_key(self):
+        directory = tempfile.mkdtemp()
+        for name in ["a.mp3", "b.mp3"]:
+            shutil.copy(self.testfile, os.path.join(directory, name))
+        tagger = Tagger()
+        tagger.add_dir(directory)
+        # ID3 files only take the keys of EasyID3.
+        self.assertRaises(ValueError, tagger.write_single, 0, "comment", "Nothing")
+        self.assertEqual(tagger.get_dirty(), [])
+        # A file that cannot be saved does not keep the others from being written.
+        tagger.write_single(0, "title", "Gone")
+        tagger.write_single(1, "title", "Saved")
+        os.remove(tagger.get_path(0))
+        report = tagger.save_all()
+        self.assertEqual(report.get_failed(), [0])
+        self.assertEqual(list(report.saves.keys()), [1])
+        self.assertEqual(tagger.get_dirty(), [0])
+        shutil.rmtree(directory)
+
+    def test_raw_tags(self):
+        # WAVE has no easy interface, only its text frames are kept.
+        from mutagen import id3, wave as mutagen_wave
+        import wave
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "cover.wav")
+        writer = wave.open(path, "wb")
+        writer.setnchannels(1)
+        writer.setsampwidth(2)
+        writer.setframerate(8000)
+        writer.writeframes(b"\x00\x00" * 800)
+        writer.close()
+        audio = mutagen_wave.WAVE(path)
+        audio.add_tags()
+        audio.tags.add(id3.TIT2(3, [u"Raw"]))
+        audio.tags.add(id3.APIC(3, "image/jpeg", 3, u"front", open("woods.jpg", "rb").read()))
+        audio.save()
+        handle, indexpath = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        tagger = Tagger(index=TagIndex(indexpath))
+        tagger.add_dir(directory)
+        self.assertEqual(tagger.errors, [])
+        self.assertEqual(tagger.read_all(0), {"TIT2": [u"Raw"]})
+        os.remove(indexpath)
+        shutil.rmtree(directory)
+
+    def test_headless_import(self):
+        # Neither the Tagger nor the command line interface may pull in wx or PIL.
+        script = "import sys, PYD3Tagger.tagger, PYD3Tagger.cli; print(sorted(set(['wx', 'PIL']) & set(sys.modules)))"
+        self.assertEqual(subprocess.check_output([sys.executable, "-c", script]).strip(), b"[]")
 
     def test_utf8(self):
         self.tagger.add_file(self.testfile)
@@ -0,0 +1,31 @@
+import threading
+
+
+class Watcher(threading.Thread):
+    """Rescans a Tagger every interval seconds until stopped.
+
+    callback is called with every RescanReport that is not empty, on the
+    watcher thread. The Tagger must not be used by other threads while a
+    rescan runs, GUIs should pass a callback that hands over to their own
+    thread and do the polling with their timers instead if that is not
+    possible.
+    """
+
+    def __init__(self, tagger, callback, interval=2.0, path=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.tagger = tagger
+        self.callback = callback
+        self.interval = interval
+        self.path = path
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            report = self.tagger.rescan(self.path)
+            if not report.is_empty():
+                self.callback(report)
+
+    def stop(self):
+        """Stops watching, a rescan in progress is finished first."""
+        self.stopped.set()